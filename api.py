@@ -1,16 +1,115 @@
+import asyncio
+import base64
+import contextlib
+import csv
 import datetime
-from typing import Optional
+import hashlib
+import io
+import json
+import os
+from typing import List, Optional
 
 import dateutil
-from fastapi import Body, Depends, FastAPI, File, HTTPException, Request, UploadFile
+import orjson
+from dotenv import load_dotenv
+from fastapi import (
+    Body,
+    Depends,
+    FastAPI,
+    File,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    UploadFile,
+)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 import auth
+import chart_cache
 import db
+import ebon_pool
+import jobs
+import metrics
+import passwords
 import rewe_process
 
-app = FastAPI()
+load_dotenv()
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 10 * 1024 * 1024))
+MAX_BATCH_UPLOAD_SIZE = int(os.getenv("MAX_BATCH_UPLOAD_SIZE", 100 * 1024 * 1024))
+# Room for the multipart boundaries and part headers around a single file.
+MULTIPART_OVERHEAD = 16 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+BILLS_PAGE_SIZE = 100
+MAX_BILLS_PAGE_SIZE = 1000
+JOBS_PAGE_SIZE = 100
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class OrjsonResponse(JSONResponse):
+    """JSON response serialized with orjson, which handles dates natively
+
+    Endpoints returning many rows return this response themselves, so FastAPI
+    does not run jsonable_encoder over the rows first.
+    """
+
+    def render(self, content) -> bytes:
+        with metrics.stage("serialize"):
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+class UploadSizeMiddleware:
+    """ASGI middleware rejecting too large uploads by their Content-Length
+
+    Starlette receives and spools the whole multipart body before an endpoint
+    or its dependencies run, so the limit has to be checked before. Chunked
+    uploads without a Content-Length are only bounded per file by
+    hash_upload, after they were spooled.
+    """
+
+    limits = {
+        "/api/pdfs": MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+        "/api/images": MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD,
+        "/api/pdfs/batch": MAX_BATCH_UPLOAD_SIZE,
+    }
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is not None:
+            response = None
+            try:
+                length = int(dict(scope["headers"]).get(b"content-length", 0))
+            except ValueError:
+                response = JSONResponse(
+                    {"detail": "Invalid Content-Length."}, status_code=400
+                )
+            else:
+                if length > limit:
+                    response = JSONResponse(
+                        {"detail": "The file is too large."}, status_code=413
+                    )
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    db.create_database()
+    jobs.start()
+    yield
+    await jobs.stop()
+    ebon_pool.shutdown()
+    passwords.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=OrjsonResponse)
 # Configure CORS (Cross-Origin Resource Sharing) settings
 origins = [
     "http://localhost",
@@ -19,13 +118,19 @@ origins = [
     "http://localhost:8081",
 ]
 
+# Added first, so it is the innermost middleware and its responses pass the
+# CORS and metrics middlewares.
+app.add_middleware(UploadSizeMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
+# Added last, so it is the outermost middleware and times the whole request.
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 def __last_day_of_month(start: datetime.date):
@@ -35,11 +140,18 @@ def __last_day_of_month(start: datetime.date):
     return next_month - datetime.timedelta(days=next_month.day)
 
 
-async def get_user_from_request(request: Request) -> db.User:
-    credentials = await auth.get_bearer_credentials(request)
-    jwt_data = auth.jwt_decode(credentials.credentials)
-    user = db.find_user(jwt_data["sub"])
-    return user
+def __encode_cursor(row: dict) -> str:
+    # The cursor points behind the last bill or expense of a page.
+    cursor = f"{row['datetime'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def __decode_cursor(cursor: str) -> (datetime.datetime, int):
+    try:
+        datetime_str, bill_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.datetime.fromisoformat(datetime_str), int(bill_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
 
 # Define an OPTIONS route for CORS preflight requests
@@ -50,48 +162,206 @@ async def options_route():
 
 @app.post("/api/login")
 async def login(user_data: dict = Body(...)):
-    user = db.find_user(user_data["username"], user_data["password"])
+    user = await db.find_user_async(user_data["username"], user_data["password"])
     if user is None:
         raise HTTPException(status_code=401)
-    token = auth.jwt_encode(user_data["username"])
+    token = auth.jwt_encode(user.name, user.id)
     return dict(token=token)
 
 
 @app.post("/api/register")
 async def register(user_data: dict = Body(...)):
-    if db.find_user(user_data["username"]):
+    # Checked first to save the bcrypt work, the unique name index decides
+    # between concurrent registrations.
+    if await db.find_user_async(user_data["username"]):
         raise HTTPException(status_code=409)
-    db.register(user_data["username"], user_data["password"])
-    token = auth.jwt_encode(user_data["username"])
-    return JSONResponse(content=dict(token=token), status_code=201)
+    user = await db.register_async(user_data["username"], user_data["password"])
+    if user is None:
+        raise HTTPException(status_code=409)
+    token = auth.jwt_encode(user.name, user.id)
+    return OrjsonResponse(content=dict(token=token), status_code=201)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/api/bills")
+async def get_bills(
+    user: db.User = Depends(auth.authenticate),
+    limit: int = Query(default=BILLS_PAGE_SIZE, ge=1, le=MAX_BILLS_PAGE_SIZE),
+    cursor: Optional[str] = None,
+):
+    before = None if cursor is None else __decode_cursor(cursor)
+    bills = await db.get_bill_dicts_async(user, limit=limit, before=before)
+    headers = {}
+    if len(bills) == limit:
+        headers["X-Next-Cursor"] = __encode_cursor(bills[-1])
+    return OrjsonResponse(bills, headers=headers)
+
+
+@app.get("/api/bills/hashes")
+async def get_bills_hashes(user: db.User = Depends(auth.authenticate)):
+    return await db.get_bill_hashes_async(user)
+
+
+@app.post("/api/bills/hashes/missing")
+async def get_missing_bills_hashes(
+    hashes: List[str] = Body(...), user: db.User = Depends(auth.authenticate)
+):
+    return await db.find_missing_hashes_async(user, hashes)
+
+
+def __isoformat(value: datetime.date) -> str:
+    return value.isoformat()
+
+
+def __export_chunks(columns: List[str], rows, format_: str):
+    # Rows are written to a buffer that is sent every EXPORT_CHUNK_SIZE rows.
+    buffer = io.StringIO()
+    if format_ == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+    else:
+
+        def write(row):
+            buffer.write(json.dumps(dict(zip(columns, row)), default=__isoformat))
+            buffer.write("\n")
+
+    for i, row in enumerate(rows, start=1):
+        write(row)
+        if i % db.EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def __export_response(
+    table: type[db.Bill] | type[db.Expense],
+    user: db.User,
+    format_: str,
+    start: Optional[datetime.date],
+    stop: Optional[datetime.date],
+) -> StreamingResponse:
+    rows = db.export_rows(table, user, start, stop)
+    chunks = __export_chunks(db.export_columns(table), rows, format_)
+    filename = f"{table.__tablename__}.{format_}"
+    # The generator is synchronous, Starlette iterates it in the threadpool.
+    return StreamingResponse(
+        chunks,
+        media_type=EXPORT_MEDIA_TYPES[format_],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 
+@app.get("/api/bills/export")
+async def export_bills(
+    format: str = Query(default="ndjson", pattern="^(ndjson|csv)$"),
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    user: db.User = Depends(auth.authenticate),
+):
+    return __export_response(db.Bill, user, format, start, stop)
+
+
+@app.get("/api/expenses/export")
+async def export_expenses(
+    format: str = Query(default="ndjson", pattern="^(ndjson|csv)$"),
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    user: db.User = Depends(auth.authenticate),
+):
+    return __export_response(db.Expense, user, format, start, stop)
+
+
+@app.get("/api/expenses/search")
+async def search_expenses(
+    q: str = Query(min_length=1, max_length=100),
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    limit: int = Query(default=BILLS_PAGE_SIZE, ge=1, le=MAX_BILLS_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user: db.User = Depends(auth.authenticate),
+):
+    before = None if cursor is None else __decode_cursor(cursor)
+    expenses = await db.search_expenses_async(user, q, start, stop, limit, before)
+    headers = {}
+    if len(expenses) == limit:
+        headers["X-Next-Cursor"] = __encode_cursor(expenses[-1])
+    return OrjsonResponse(expenses, headers=headers)
+
+
+@app.get("/api/products/price-changes")
+async def get_price_changes(
+    limit: int = Query(default=20, ge=1, le=MAX_BILLS_PAGE_SIZE),
+    user: db.User = Depends(auth.authenticate),
+):
+    return OrjsonResponse(await db.get_price_changes_async(user, limit))
 
-@app.get("/api/bills", dependencies=[Depends(auth.authenticate)])
-async def get_bills(request: Request, limit: Optional[int] = None):
-    user = await get_user_from_request(request)
-    assert user is not None
-    bills = db.get_bills(user, limit=limit)
-    data = []
-    for bill in bills:
-        data.append(db.jsonify_bill(bill))
-    return data
 
+@app.get("/api/products/{name:path}/prices")
+async def get_prices(
+    name: str,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    user: db.User = Depends(auth.authenticate),
+):
+    prices = await db.get_price_history_async(user, name, start, stop)
+    if prices is None:
+        raise HTTPException(status_code=404, detail="Unknown product.")
+    return OrjsonResponse(dict(name=name, prices=prices))
 
-@app.get("/api/bills/hashes", dependencies=[Depends(auth.authenticate)])
-async def get_bills_hashes(request: Request):
-    user = await get_user_from_request(request)
-    assert user is not None
-    bills = db.get_bills(user)
-    hashes = [bill.file_hash for bill in bills]
-    return hashes
 
+async def __chart_response(
+    request: Request,
+    user: db.User,
+    chart: str,
+    start: datetime.date,
+    stop: datetime.date,
+    dt: datetime.timedelta,
+    columnar: bool,
+) -> Response:
+    # The key holds the resolved date range, the default ranges move with
+    # the current date.
+    key = (user.id, chart, start, stop, columnar)
+    version = await db.get_user_updated_async(user)
+    cached = chart_cache.cache.get(key, version)
+    if cached is None:
+        time_data = await db.retrieve_sum_expenses_async(user, start, stop, dt)
+        product_data = await db.retrieve_product_sum_async(user, start, stop)
+        if columnar:
+            json_ = dict(
+                dates=[day for day, _ in time_data],
+                values=[value for _, value in time_data],
+                product_names=[name for name, _ in product_data],
+                product_totals=[total for _, total in product_data],
+            )
+        else:
+            json_ = dict(
+                time_data=time_data,
+                product_data=product_data,
+            )
+        with metrics.stage("serialize"):
+            body = orjson.dumps(json_)
+        cached = chart_cache.cache.put(key, body, version)
+    etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if chart_cache.etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
-@app.get("/api/charts/daily", dependencies=[Depends(auth.authenticate)])
+
+@app.get("/api/charts/daily")
 async def get_daily_data(
-    request: Request, month: Optional[int] = None, year: Optional[int] = None
+    request: Request,
+    month: Optional[int] = None,
+    year: Optional[int] = None,
+    columnar: bool = False,
+    user: db.User = Depends(auth.authenticate),
 ):
-    user = await get_user_from_request(request)
-    assert user is not None
     if month is None or year is None:
         stop = datetime.datetime.now().date()
         start = stop - datetime.timedelta(days=30)
@@ -104,19 +374,16 @@ async def get_daily_data(
                 status_code=400, detail="Invalid year or month provided."
             )
     dt = datetime.timedelta(days=1)
-    time_data = db.retrieve_sum_expenses(user, start, stop, dt)
-    product_data = db.retrieve_product_sum(user, start, stop)
-    json_ = dict(
-        time_data=time_data,
-        product_data=product_data,
-    )
-    return json_
+    return await __chart_response(request, user, "daily", start, stop, dt, columnar)
 
 
-@app.get("/api/charts/monthly", dependencies=[Depends(auth.authenticate)])
-async def get_monthly_data(request: Request, year: Optional[int] = None):
-    user = await get_user_from_request(request)
-    assert user is not None
+@app.get("/api/charts/monthly")
+async def get_monthly_data(
+    request: Request,
+    year: Optional[int] = None,
+    columnar: bool = False,
+    user: db.User = Depends(auth.authenticate),
+):
     if year is None:
         stop = datetime.date.today()
         start = stop - datetime.timedelta(days=365)
@@ -125,29 +392,19 @@ async def get_monthly_data(request: Request, year: Optional[int] = None):
         start = datetime.date(year, 1, 1)
         stop = datetime.date(year, 12, 31)
     dt = dateutil.relativedelta.relativedelta(months=1)
-    time_data = db.retrieve_sum_expenses(user, start, stop, dt)
-    product_data = db.retrieve_product_sum(user, start, stop)
-    json_ = dict(
-        time_data=time_data,
-        product_data=product_data,
-    )
-    return json_
+    return await __chart_response(request, user, "monthly", start, stop, dt, columnar)
 
 
-@app.get("/api/charts/yearly", dependencies=[Depends(auth.authenticate)])
-async def get_yearly_data(request: Request):
-    user = await get_user_from_request(request)
-    assert user is not None
+@app.get("/api/charts/yearly")
+async def get_yearly_data(
+    request: Request,
+    columnar: bool = False,
+    user: db.User = Depends(auth.authenticate),
+):
     stop = datetime.date(datetime.datetime.today().year, 1, 1)
     dt = dateutil.relativedelta.relativedelta(years=1)
     start = stop - 4 * dt
-    time_data = db.retrieve_sum_expenses(user, start, stop, dt)
-    product_data = db.retrieve_product_sum(user, start, stop)
-    json_ = dict(
-        time_data=time_data,
-        product_data=product_data,
-    )
-    return json_
+    return await __chart_response(request, user, "yearly", start, stop, dt, columnar)
 
 
 @app.post("/api/images", dependencies=[Depends(auth.authenticate)])
@@ -155,11 +412,127 @@ async def process_upload_image(file: UploadFile = File(...)):
     raise NotImplementedError("No image processing yet")
 
 
-@app.post("/api/pdfs", dependencies=[Depends(auth.authenticate)])
-async def process_upload_pdf(request: Request, file: UploadFile = File(...)):
-    contents = await file.read()
-    await file.close()
+async def hash_upload(file: UploadFile) -> str:
+    """Hash an upload chunk by chunk, without loading it into memory"""
+    sha256 = hashlib.sha256()
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_SIZE:
+            raise HTTPException(status_code=413, detail="The file is too large.")
+        sha256.update(chunk)
+    await file.seek(0)
+    return sha256.hexdigest()
+
+
+@app.post("/api/pdfs")
+async def process_upload_pdf(
+    file: UploadFile = File(...),
+    background: bool = False,
+    user: db.User = Depends(auth.authenticate),
+):
+    try:
+        # Known eBons are recognized by their hash, before any parsing.
+        file_hash = await hash_upload(file)
+        bill = await db.find_bill_by_hash_async(user, file_hash)
+        if bill is not None:
+            return await db.jsonify_bill_async(user, bill_id=bill.id)
+        contents = await file.read()
+    finally:
+        await file.close()
+
+    if background:
+        # The eBon is parsed by the job workers, the client polls the job.
+        job = await db.add_job_async(user, file.filename, file_hash, contents)
+        jobs.notify()
+        return OrjsonResponse(
+            content=db.jsonify_job(job),
+            status_code=202,
+            headers={"Location": f"/api/jobs/{job.id}"},
+        )
+
+    expenses, total = await ebon_pool.extract(contents)
+    bill_id = await run_in_threadpool(
+        rewe_process.store_rewe_ebon, expenses, total, file_hash, user.id
+    )
+    chart_cache.cache.invalidate(user.id)
+    return await db.jsonify_bill_async(user, bill_id=bill_id)
+
+
+@app.post("/api/pdfs/batch")
+async def process_upload_pdfs(
+    files: List[UploadFile] = File(...), user: db.User = Depends(auth.authenticate)
+):
+    status = [dict(file=file.filename) for file in files]
+    hashes = []
+    for file_status, file in zip(status, files):
+        try:
+            hashes.append(await hash_upload(file))
+        except HTTPException as e:
+            file_status.update(status="error", detail=e.detail)
+            hashes.append(None)
+            await file.close()
+
+    known = await db.find_bill_ids_by_hashes_async(user, [h for h in hashes if h])
+    pending = []
+    for file_status, file, file_hash in zip(status, files, hashes):
+        if file_hash is None:
+            continue
+        bill_id = known.get(file_hash)
+        if bill_id is not None:
+            file_status.update(status="duplicate", bill_id=bill_id)
+            await file.close()
+        else:
+            pending.append((file_status, file, file_hash))
+
+    # A batch keeps at most one eBon per worker in the pool, so it does not
+    # fill the queue and starve the uploads of other users.
+    workers = asyncio.Semaphore(ebon_pool.PDF_WORKERS)
+
+    async def extract(file: UploadFile):
+        try:
+            ebon = await file.read()
+        finally:
+            await file.close()
+        async with workers:
+            return await ebon_pool.extract(ebon)
+
+    results = await asyncio.gather(
+        *[extract(file) for _, file, _ in pending], return_exceptions=True
+    )
+    parsed = []
+    for (file_status, _, file_hash), result in zip(pending, results):
+        if isinstance(result, HTTPException):
+            file_status.update(status="error", detail=result.detail)
+        elif isinstance(result, Exception):
+            file_status.update(status="error", detail="Invalid eBon.")
+        else:
+            expenses, total = result
+            parsed.append((file_status, (expenses, total, file_hash)))
+
+    if parsed:
+        bills = await run_in_threadpool(
+            rewe_process.store_rewe_ebons, [ebon for _, ebon in parsed], user.id
+        )
+        for (file_status, _), (bill_id, created) in zip(parsed, bills):
+            file_status["status"] = "created" if created else "duplicate"
+            file_status["bill_id"] = bill_id
+        chart_cache.cache.invalidate(user.id)
+    return status
+
+
+@app.get("/api/jobs")
+async def get_jobs(
+    user: db.User = Depends(auth.authenticate),
+    limit: int = Query(default=JOBS_PAGE_SIZE, ge=1, le=MAX_BILLS_PAGE_SIZE),
+):
+    jobs_ = await db.get_jobs_async(user, limit)
+    return OrjsonResponse([db.jsonify_job(job) for job in jobs_])
+
 
-    user = await get_user_from_request(request)
-    bill_id = rewe_process.parse_rewe_ebon(contents, user.id)
-    return db.jsonify_bill(bill_id=bill_id)
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: int, user: db.User = Depends(auth.authenticate)):
+    job = await db.get_job_async(user, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return db.jsonify_job(job)
@@ -1,3 +1,4 @@
+import collections
 import datetime
 import os
 
@@ -6,14 +7,24 @@ from dotenv import load_dotenv
 from fastapi import HTTPException, Request
 from fastapi.security import HTTPBearer
 
+import db
+import metrics
+
 load_dotenv()
 JWT_ALG = "HS256"
 JWT_SECRET = os.getenv("JWT_SECRET")
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 1024))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 300))
+
+# Maps verified tokens to (expiry timestamp, user), least recently used first.
+_token_users = collections.OrderedDict()
 
 
-def jwt_encode(user_name):
+def jwt_encode(user_name, user_id=None):
     exp = datetime.datetime.now() + datetime.timedelta(days=30)
     data = dict(sub=user_name, exp=exp)
+    if user_id is not None:
+        data["uid"] = user_id
     token = jwt.encode(data, JWT_SECRET, algorithm=JWT_ALG)
     return token
 
@@ -29,15 +40,59 @@ async def get_bearer_credentials(request: Request):
     return credentials
 
 
-async def authenticate(request: Request):
+def _cache_user(token: str, exp: float, user: db.User):
+    # A verified token stays valid until it expires, but the cached user is
+    # refreshed from the database every AUTH_CACHE_TTL seconds.
+    expires = min(exp, datetime.datetime.now().timestamp() + AUTH_CACHE_TTL)
+    _token_users[token] = (expires, user)
+    while len(_token_users) > AUTH_CACHE_SIZE:
+        _token_users.popitem(last=False)
+
+
+def _cached_user(token: str) -> db.User | None:
+    entry = _token_users.get(token)
+    if entry is None:
+        return None
+    expires, user = entry
+    if expires < datetime.datetime.now().timestamp():
+        del _token_users[token]
+        return None
+    _token_users.move_to_end(token)
+    return user
+
+
+async def authenticate(request: Request) -> db.User:
+    """Return the user of the bearer token of a request
+
+    The token is decoded once per request and the user is cached by token, so
+    most requests do not touch the database for authentication.
+    """
+    with metrics.stage("auth"):
+        return await _authenticate(request)
+
+
+async def _authenticate(request: Request) -> db.User:
     credentials = await get_bearer_credentials(request)
     if not credentials:
         raise HTTPException(status_code=401)
     if not credentials.scheme == "Bearer":
         raise HTTPException(status_code=401)
-    try:
-        user_data = jwt_decode(credentials.credentials)
-    except jwt.exceptions.InvalidSignatureError:
-        raise HTTPException(status_code=401)
-    if user_data["exp"] < datetime.datetime.now().timestamp():
-        raise HTTPException(status_code=401)
+    token = credentials.credentials
+    user = _cached_user(token)
+    if user is None:
+        try:
+            user_data = jwt_decode(token)
+        except jwt.exceptions.InvalidTokenError:
+            raise HTTPException(status_code=401)
+        if user_data["exp"] < datetime.datetime.now().timestamp():
+            raise HTTPException(status_code=401)
+        # Tokens issued before the user id was added only carry the name.
+        if "uid" in user_data:
+            user = await db.get_user_async(user_data["uid"])
+        else:
+            user = await db.find_user_async(user_data["sub"])
+        if user is None or user.name != user_data["sub"]:
+            raise HTTPException(status_code=401)
+        _cache_user(token, user_data["exp"], user)
+    request.state.user = user
+    return user
@@ -0,0 +1,471 @@
+"""Benchmark the API endpoints in-process against a temporary database
+
+The app is driven through httpx's ASGI transport, so neither a server nor
+data/expenses.db is involved. The database is seeded with synthetic users and
+bills first. Every scenario is measured twice: one request after the other
+for the latency and the queries per request, then with concurrent clients for
+the throughput. The background job workers are not started, their polling
+would show up in the query counts.
+
+Some scenarios are measured while other clients keep sending the requests of
+a background scenario, e.g. the chart reads while eBons are uploaded. The
+requests of the background clients are not measured, their queries not
+counted.
+
+Results can be saved as a baseline, a later run compared to the baseline
+prints the relative changes and fails if a metric got worse than allowed.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import datetime
+import json
+import os
+import pathlib
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import urllib.parse
+
+if __name__ == "__main__":
+    # db creates its engines on import, so the temporary database is chosen
+    # first. The eBon worker processes import this module as __mp_main__ and
+    # inherit the database with the environment.
+    TMP_DIR = pathlib.Path(tempfile.mkdtemp(prefix="bench_api_"))
+    os.environ["DATABASE_URL"] = f"sqlite:///{TMP_DIR / 'expenses.db'}"
+
+# isort: split
+
+import httpx
+import sqlalchemy
+
+import api
+import auth
+import chart_cache
+import db
+import ebon_pool
+import passwords
+from benchmarks import dataset
+from benchmarks.ebon_text import generate_ebon_text, render_pdf
+
+METRICS = ["p50", "p95", "p99", "queries", "throughput", "rejected"]
+# Lower is better for all metrics but the throughput.
+HIGHER_IS_BETTER = {"throughput"}
+# Rejected requests are retried after this time instead of the Retry-After.
+RETRY_INTERVAL = 0.05
+
+_queries = 0
+# Unset in the background clients, whose queries are not counted.
+_counting = contextvars.ContextVar("counting", default=True)
+
+
+def _count_query(*args):
+    global _queries
+    if _counting.get():
+        _queries += 1
+
+
+def charts_daily(rng: random.Random, user: dict):
+    day = user["start"] + (user["stop"] - user["start"]) * rng.random()
+    return "GET", f"/api/charts/daily?year={day.year}&month={day.month}", {}
+
+
+def charts_monthly(rng: random.Random, user: dict):
+    year = rng.randint(user["start"].year, user["stop"].year)
+    return "GET", f"/api/charts/monthly?year={year}", {}
+
+
+def charts_yearly(rng: random.Random, user: dict):
+    return "GET", "/api/charts/yearly", {}
+
+
+def bills(rng: random.Random, user: dict):
+    return "GET", "/api/bills", {}
+
+
+def bills_1000(rng: random.Random, user: dict):
+    return "GET", "/api/bills?limit=1000", {}
+
+
+def bills_hashes(rng: random.Random, user: dict):
+    return "GET", "/api/bills/hashes", {}
+
+
+def hashes_missing(rng: random.Random, user: dict):
+    # A client syncing its eBon folder: most eBons are known, a few are new.
+    known = rng.sample(user["hashes"], min(90, len(user["hashes"])))
+    new = [f"{rng.getrandbits(256):064x}" for _ in range(10)]
+    return "POST", "/api/bills/hashes/missing", dict(json=known + new)
+
+
+def search(rng: random.Random, user: dict):
+    name = rng.choice(user["products"])
+    start = rng.randint(0, len(name) - 4)
+    return "GET", "/api/expenses/search", dict(params=dict(q=name[start : start + 4]))
+
+
+def prices(rng: random.Random, user: dict):
+    name = rng.choice(user["products"])
+    return "GET", f"/api/products/{urllib.parse.quote(name, safe='')}/prices", {}
+
+
+def price_changes(rng: random.Random, user: dict):
+    return "GET", "/api/products/price-changes", {}
+
+
+def export_expenses(rng: random.Random, user: dict):
+    year = rng.randint(user["start"].year, user["stop"].year)
+    params = dict(start=f"{year}-01-01", stop=f"{year}-12-31")
+    return "GET", "/api/expenses/export", dict(params=params)
+
+
+def pdf_upload(rng: random.Random, user: dict):
+    # Every upload is a new bill, after the seeded ones.
+    user["uploads"] += 1
+    dt = datetime.datetime.combine(
+        user["stop"] + datetime.timedelta(days=1), datetime.time(8)
+    ) + datetime.timedelta(minutes=user["uploads"])
+    pdf = render_pdf(generate_ebon_text(rng, dt))
+    return "POST", "/api/pdfs", dict(files={"file": ("ebon.pdf", pdf)})
+
+
+def charts_during_uploads(rng: random.Random, user: dict):
+    # A slow upload must not stall the chart reads of the other clients.
+    return charts_monthly(rng, user)
+
+
+# The uploads come last, they invalidate the cached charts.
+SCENARIOS = {
+    scenario.__name__: scenario
+    for scenario in [
+        charts_daily,
+        charts_monthly,
+        charts_yearly,
+        bills,
+        bills_1000,
+        bills_hashes,
+        hashes_missing,
+        search,
+        prices,
+        price_changes,
+        export_expenses,
+        pdf_upload,
+        charts_during_uploads,
+    ]
+}
+# The scenarios run by background clients while a scenario is measured. Each
+# client keeps one request in flight, with a client per eBon worker the pool
+# stays busy.
+BACKGROUND = {"charts_during_uploads": pdf_upload}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        "Benchmark the API in-process against a temporary database"
+    )
+    parser.add_argument(
+        "-u",
+        "--users",
+        type=int,
+        default=5,
+        help="Number of synthetic users",
+    )
+    parser.add_argument(
+        "-y",
+        "--years",
+        type=int,
+        default=3,
+        help="Years of bills per user",
+    )
+    parser.add_argument(
+        "-n",
+        "--requests",
+        type=int,
+        default=200,
+        help="Number of measured requests per scenario and phase",
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=10,
+        help="Number of unmeasured requests before each scenario",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of concurrent clients in the throughput phase",
+    )
+    parser.add_argument(
+        "-s",
+        "--scenarios",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="Scenarios to run",
+    )
+    parser.add_argument(
+        "--chart-cache",
+        action="store_true",
+        help="Serve repeated chart requests from the chart cache",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the dataset and of the requests",
+    )
+    parser.add_argument(
+        "--save",
+        type=pathlib.Path,
+        help="Save the results as JSON, e.g. as a baseline",
+    )
+    parser.add_argument(
+        "--compare",
+        type=pathlib.Path,
+        help="Compare the results to a saved baseline",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change of a metric that counts as a regression",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def prepare_users(users: list[db.User], today: datetime.date, years: int):
+    prepared = []
+    for user in users:
+        token = auth.jwt_encode(user.name, user.id)
+        with sqlalchemy.orm.Session(db.read_engine) as session:
+            products = session.scalars(
+                sqlalchemy.select(db.Product.name).where(db.Product.user_id == user.id)
+            ).all()
+        prepared.append(
+            dict(
+                id=user.id,
+                headers={"Authorization": "Bearer " + token},
+                hashes=db.get_bill_hashes(user),
+                products=products,
+                start=today - datetime.timedelta(days=365 * years),
+                stop=today,
+                uploads=0,
+            )
+        )
+    return prepared
+
+
+async def request(client: httpx.AsyncClient, user: dict, method: str, url: str, **kw):
+    response = await client.request(method, url, headers=user["headers"], **kw)
+    if response.status_code >= 400 and response.status_code != 503:
+        raise RuntimeError(f"{method} {url}: {response.status_code} {response.text}")
+    return response
+
+
+async def measure_latency(
+    client: httpx.AsyncClient, scenario, users: list[dict], rng, n: int, warmup: int
+) -> (list[float], float):
+    """Return the latencies in ms and the mean number of queries per request"""
+    latencies = []
+    queries = 0
+    for i in range(warmup + n):
+        user = rng.choice(users)
+        method, url, kwargs = scenario(rng, user)
+        before = _queries
+        start = time.perf_counter()
+        response = await request(client, user, method, url, **kwargs)
+        if response.status_code == 503:
+            raise RuntimeError(f"{method} {url} was rejected without concurrency")
+        if i >= warmup:
+            latencies.append(1000 * (time.perf_counter() - start))
+            queries += _queries - before
+    return latencies, queries / n
+
+
+async def measure_throughput(
+    client: httpx.AsyncClient,
+    scenario,
+    users: list[dict],
+    rng,
+    n: int,
+    concurrency: int,
+) -> (float, float):
+    """Return the requests per second of concurrent clients
+
+    Requests rejected with 503 are retried, the second value is the share of
+    rejected requests.
+    """
+    requests = []
+    for _ in range(n):
+        user = rng.choice(users)
+        requests.append((user, *scenario(rng, user)))
+    pending = iter(requests)
+    rejected = 0
+
+    async def work():
+        nonlocal rejected
+        for user, method, url, kwargs in pending:
+            while (
+                await request(client, user, method, url, **kwargs)
+            ).status_code == 503:
+                rejected += 1
+                await asyncio.sleep(RETRY_INTERVAL)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[work() for _ in range(concurrency)])
+    return n / (time.perf_counter() - start), rejected / (n + rejected)
+
+
+async def run_background(client: httpx.AsyncClient, scenario, users: list[dict], rng):
+    """Send the requests of a scenario one after the other until cancelled"""
+    _counting.set(False)
+    while True:
+        user = rng.choice(users)
+        # Rendering an eBon takes a while, it would stall the event loop
+        # shared with the measured client.
+        method, url, kwargs = await asyncio.to_thread(scenario, rng, user)
+        response = await request(client, user, method, url, **kwargs)
+        if response.status_code == 503:
+            await asyncio.sleep(RETRY_INTERVAL)
+
+
+async def run(args: argparse.Namespace, users: list[dict]) -> dict:
+    rng = random.Random(args.seed)
+    results = {}
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for name in SCENARIOS:
+            if name not in args.scenarios:
+                continue
+            scenario = SCENARIOS[name]
+            background = [
+                asyncio.create_task(
+                    run_background(
+                        client, BACKGROUND[name], users, random.Random(args.seed + i)
+                    )
+                )
+                for i in range(ebon_pool.PDF_WORKERS if name in BACKGROUND else 0)
+            ]
+            try:
+                latencies, queries = await measure_latency(
+                    client, scenario, users, rng, args.requests, args.warmup
+                )
+                throughput, rejected = await measure_throughput(
+                    client, scenario, users, rng, args.requests, args.concurrency
+                )
+            finally:
+                for task in background:
+                    task.cancel()
+                await asyncio.gather(*background, return_exceptions=True)
+            percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+            results[name] = dict(
+                p50=percentiles[49],
+                p95=percentiles[94],
+                p99=percentiles[98],
+                queries=queries,
+                throughput=throughput,
+                rejected=rejected,
+            )
+            print_row(name, results[name])
+    await db.async_engine.dispose()
+    await db.async_read_engine.dispose()
+    return results
+
+
+def print_header():
+    print(
+        f"{'scenario':<24}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'queries':>10}{'req/s':>10}{'rejected':>10}"
+    )
+
+
+def print_row(name: str, result: dict):
+    print(
+        f"{name:<24}{result['p50']:>10.2f}{result['p95']:>10.2f}"
+        f"{result['p99']:>10.2f}{result['queries']:>10.1f}"
+        f"{result['throughput']:>10.1f}{result['rejected']:>10.1%}"
+    )
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Print the relative changes to the baseline, return the regressions"""
+    print(f"\nChanges to the baseline, ! marks regressions above {threshold:.0%}")
+    print_header()
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        cells = []
+        for metric in METRICS:
+            old, new = baseline[name][metric], result[metric]
+            if old:
+                change = (new - old) / old
+            else:
+                change = 0.0 if new == old else float("inf")
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            regression = worse > threshold
+            regressions += regression
+            cells.append(f"{change:+.1%}{'!' if regression else ' '}")
+        print(f"{name:<24}" + "".join(f"{cell:>10}" for cell in cells))
+    return regressions
+
+
+def main():
+    args = parse_args()
+    sqlalchemy.event.listen(sqlalchemy.Engine, "before_cursor_execute", _count_query)
+    if not args.chart_cache:
+        # Every chart request queries the database, as after an upload.
+        chart_cache.cache.max_size = 0
+    try:
+        db.create_database()
+        today = datetime.date.today()
+        start = time.perf_counter()
+        users = dataset.seed(args.users, args.years, seed=args.seed, today=today)
+        with db.engine.connect() as connection:
+            n_bills, n_expenses = (
+                connection.scalar(
+                    sqlalchemy.select(sqlalchemy.func.count()).select_from(table)
+                )
+                for table in (db.Bill, db.Expense)
+            )
+        print(
+            f"Seeded {len(users)} users, {n_bills:,} bills and {n_expenses:,} "
+            f"expenses in {time.perf_counter() - start:.1f} s\n"
+        )
+
+        users = prepare_users(users, today, args.years)
+        print_header()
+        results = asyncio.run(run(args, users))
+    finally:
+        ebon_pool.shutdown()
+        passwords.shutdown()
+        db.engine.dispose()
+        db.read_engine.dispose()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+    config = {
+        name: getattr(args, name)
+        for name in ("users", "years", "requests", "concurrency", "chart_cache")
+    }
+    if args.save is not None:
+        args.save.write_text(json.dumps(dict(config=config, results=results), indent=2))
+        print(f"\nSaved the results to {args.save}")
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+        if baseline["config"] != config:
+            print(f"\nThe baseline was measured with {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            raise SystemExit(f"{regressions} metrics regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import argparse
+import time
+
+import rewe_process
+from benchmarks.ebon_text import generate_corpus
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("Benchmark the eBon text parser")
+    parser.add_argument(
+        "-n",
+        "--ebons",
+        type=int,
+        default=2000,
+        help="Number of synthetic eBons",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=5,
+        help="Number of runs, the fastest one is reported",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    texts = generate_corpus(args.ebons)
+    n_lines = sum(text.count("\n") + 1 for text in texts)
+    parse = rewe_process.parse_rewe_ebon_text
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for text in texts:
+            parse(text)
+        best = min(best, time.perf_counter() - start)
+    print(f"{len(texts)} eBons, {n_lines} lines in {best:.3f} s")
+    print(f"{n_lines / best:,.0f} lines/s, {len(texts) / best:,.0f} eBons/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Synthetic multi-user dataset for the API benchmarks
+
+Every user shops a few times a week over the last years, each bill is a
+synthetic eBon text stored the way the API stores parsed eBons. The product
+names come from a catalog a few hundred entries long, like the assortment a
+household buys from over the years.
+"""
+
+import datetime
+import hashlib
+import random
+
+import sqlalchemy
+
+import db
+import passwords
+import rewe_process
+from benchmarks.ebon_text import PRODUCTS, generate_ebon_text
+
+PASSWORD = "benchmark"
+BRANDS = ["", "BIO ", "JA! ", "REWE BESTE WAHL ", "REWE BIO ", "GUT&GUENSTIG "]
+VARIANTS = ["", " 500G", " 1L", " 6X1,5L", " 250G", " FAMILIENPACKUNG"]
+BATCH_SIZE = 500
+
+
+def product_catalog(size: int, rng: random.Random) -> list[str]:
+    names = [
+        f"{brand}{product}{variant}"
+        for brand in BRANDS
+        for product in PRODUCTS
+        for variant in VARIANTS
+    ]
+    return rng.sample(names, min(size, len(names)))
+
+
+def shopping_datetimes(
+    rng: random.Random, start: datetime.date, stop: datetime.date
+) -> list[datetime.datetime]:
+    """Return the shopping trips of a household between start and stop
+
+    Each household shops 1 to 5 times a week on average.
+    """
+    trips_per_day = rng.uniform(1, 5) / 7
+    datetimes = []
+    day = start
+    while day <= stop:
+        if rng.random() < trips_per_day:
+            dt = datetime.datetime.combine(day, datetime.time(8)) + datetime.timedelta(
+                seconds=rng.randint(0, 14 * 3600)
+            )
+            datetimes.append(dt)
+        day += datetime.timedelta(days=1)
+    return datetimes
+
+
+def seed(
+    n_users: int,
+    years: int,
+    n_products: int = 300,
+    seed: int = 0,
+    today: datetime.date | None = None,
+) -> list[db.User]:
+    """Store n_users users with bills of the last years in db.engine"""
+    rng = random.Random(seed)
+    today = today or datetime.date.today()
+    start = today - datetime.timedelta(days=365 * years)
+    catalog = product_catalog(n_products, rng)
+    # All users share the password, so bcrypt runs once and not once per user.
+    hash_ = passwords.context.hash(PASSWORD)
+    with sqlalchemy.orm.Session(db.engine, expire_on_commit=False) as session:
+        users = [db.User(name=f"user{i}", password=hash_) for i in range(n_users)]
+        session.add_all(users)
+        session.commit()
+
+    for user in users:
+        ebons = []
+        for dt in shopping_datetimes(rng, start, today):
+            text = generate_ebon_text(rng, dt, catalog)
+            expenses, total = rewe_process.parse_rewe_ebon_text(text)
+            ebons.append((expenses, total, hashlib.sha256(text.encode()).hexdigest()))
+        for i in range(0, len(ebons), BATCH_SIZE):
+            rewe_process.store_rewe_ebons(ebons[i : i + BATCH_SIZE], user.id)
+    return users
@@ -0,0 +1,135 @@
+"""Synthetic REWE eBon texts, as extracted by pdfminer
+
+The texts follow the layout of real eBons closely enough to exercise every
+line pattern of rewe_process.py, without shipping real receipts. render_pdf
+wraps a text in a minimal PDF, from which pdfminer extracts the same lines.
+"""
+
+import datetime
+import random
+
+PRODUCTS = [
+    "BANANE CHIQUITA",
+    "VOLLMILCH 3,5%",
+    "BIO EIER 10ER",
+    "TOMATEN RISPEN",
+    "ROGGENMISCHBROT",
+    "GOUDA JUNG SCHEIBEN",
+    "APFEL ELSTAR",
+    "HAFERFLOCKEN ZART",
+    "BUTTER",
+    "SPAGHETTI",
+    "JOGHURT NATUR",
+    "MINERALWASSER",
+]
+WEIGHED_PRODUCTS = ["BANANE CHIQUITA", "TOMATEN RISPEN", "APFEL ELSTAR"]
+BUTCHER_PRODUCTS = ["HAEHNCHENBRUST", "RINDERHACKFLEISCH", "LACHSFILET"]
+HEADER = [
+    "REWE",
+    "REWE Markt GmbH",
+    "Musterstr. 1",
+    "12345 Musterstadt",
+    "Telefon: 0123-456789",
+    "UID Nr.: DE812706034",
+    "EUR",
+]
+
+
+def __euro(cents: int) -> str:
+    return f"{cents // 100},{cents % 100:02d}"
+
+
+def __kg(grams: int) -> str:
+    return f"{grams // 1000},{grams % 1000:03d}"
+
+
+def __product_line(name: str, cents: int, tax: str = "B") -> str:
+    return f"{name:<32}{__euro(cents):>8} {tax}"
+
+
+def generate_ebon_text(
+    rng: random.Random, dt: datetime.datetime, products: list[str] = PRODUCTS
+) -> str:
+    lines = list(HEADER)
+    total = 0
+    for _ in range(rng.randint(3, 30)):
+        kind = rng.random()
+        if kind < 0.15:
+            grams = rng.randint(150, 2500)
+            price_per_kg = rng.randint(99, 699)
+            cents = grams * price_per_kg // 1000
+            lines.append(__product_line(rng.choice(WEIGHED_PRODUCTS), cents))
+            lines.append(f"    {__kg(grams)} kg x    {__euro(price_per_kg)} EUR/kg")
+        elif kind < 0.2:
+            grams = rng.randint(150, 1500)
+            cents = grams * rng.randint(799, 2999) // 1000
+            lines.append(__product_line(rng.choice(BUTCHER_PRODUCTS), cents))
+            lines.append(f"    Handeingabe E-Bon {__kg(grams)} kg")
+        elif kind < 0.35:
+            quantity = rng.randint(2, 6)
+            price = rng.randint(19, 499)
+            cents = quantity * price
+            lines.append(__product_line(rng.choice(products), cents))
+            lines.append(f"    {quantity} Stk x    {__euro(price)}")
+        else:
+            cents = rng.randint(19, 1299)
+            lines.append(__product_line(rng.choice(products), cents))
+        total += cents
+    lines += [
+        "-" * 40,
+        f"SUMME                  EUR     {__euro(total)}",
+        "=" * 40,
+        f"Geg. Mastercard        EUR     {__euro(total)}",
+        "",
+        "Steuer  %     Netto    Steuer    Brutto",
+        "Gesamtbetrag",
+        "",
+        f"Datum:    {dt:%d.%m.%Y}",
+        f"Uhrzeit:  {dt:%H:%M:%S} Uhr",
+        f"Beleg-Nr. {rng.randint(1000, 9999)}",
+        f"Trace-Nr. {rng.randint(100000, 999999)}",
+        "",
+        "Vielen Dank fuer Ihren Einkauf",
+    ]
+    return "\n".join(lines)
+
+
+def generate_corpus(n: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1, 8)
+    texts = []
+    for _ in range(n):
+        dt = start + datetime.timedelta(
+            days=rng.randint(0, 5 * 365), seconds=rng.randint(0, 12 * 3600)
+        )
+        texts.append(generate_ebon_text(rng, dt))
+    return texts
+
+
+def render_pdf(text: str) -> bytes:
+    """Render the lines of a text with a monospace font on a single page"""
+    content = ["BT", "/F1 9 Tf", "11 TL", "30 800 Td"]
+    for line in text.split("\n"):
+        line = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+        content.append(f"({line}) Tj T*")
+    content.append("ET")
+    stream = "\n".join(content).encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 400 842] /Contents 4 0 R"
+        b" /Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    pdf += b"startxref\n%d\n%%%%EOF\n" % xref
+    return pdf
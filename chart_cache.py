@@ -0,0 +1,80 @@
+"""In-process cache for the rendered chart responses
+
+The charts of a user only change when the user gets a new bill, so the
+rendered responses are cached per user, endpoint and date range. Each entry
+keeps the version of the data it was computed from, the time the bills of the
+user last changed according to the database. An entry is only served while
+the version is current, which also covers bills added by other processes,
+e.g. by the command line scripts. Adding a bill through the API drops the
+entries of its user right away.
+"""
+
+import collections
+import datetime
+import hashlib
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 1024))
+CHART_CACHE_TTL = float(os.getenv("CHART_CACHE_TTL", 300))
+
+
+class ChartCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self, key: tuple, version: datetime.datetime | None
+    ) -> tuple[str, bytes] | None:
+        """Return the ETag and body cached for (user id, ...) at a data version"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, entry_version, etag, body = entry
+            if expires < time.monotonic() or entry_version != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return etag, body
+
+    def put(
+        self, key: tuple, body: bytes, version: datetime.datetime | None
+    ) -> tuple[str, bytes]:
+        """Cache a body computed from the data version of the user
+
+        The version has to be read before the data, so a bill added in the
+        meantime leaves the entry outdated rather than the version.
+        """
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, etag, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return etag, body
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+
+cache = ChartCache(CHART_CACHE_SIZE, CHART_CACHE_TTL)
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip().removeprefix("W/")
+        if candidate in ("*", etag):
+            return True
+    return False
@@ -1,13 +1,108 @@
+import bisect
+import collections
 import datetime
+import difflib
+import os
 from typing import List, Optional
 
 import sqlalchemy
+import sqlalchemy.ext.asyncio
 import sqlalchemy.orm
-from passlib.hash import bcrypt
+from dotenv import load_dotenv
 from sqlalchemy import ForeignKey
-from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 
-engine = sqlalchemy.create_engine("sqlite:///data/expenses.db", echo=False)
+import metrics
+import passwords
+
+load_dotenv()
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///data/expenses.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 8))
+DB_WRITE_POOL_SIZE = int(os.getenv("DB_WRITE_POOL_SIZE", 1))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", 30))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+DB_CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", 16 * 1024))  # KiB per connection
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 256 * 1024 * 1024))
+# Hashes are looked up in chunks to stay below SQLite's parameter limit.
+HASH_CHUNK_SIZE = 500
+EXPORT_CHUNK_SIZE = 1000
+SEARCH_FUZZY_MATCHES = 10
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", 100_000))
+
+
+def _pool_options(url: sqlalchemy.URL, readonly: bool) -> dict:
+    database = url.database or ""
+    if url.get_backend_name() == "sqlite" and (
+        database in ("", ":memory:")
+        or "mode=memory" in database
+        or url.query.get("mode") == "memory"
+    ):
+        # Memory databases get a pool that keeps their connection, it takes
+        # none of the size options.
+        return {}
+    if readonly:
+        return dict(pool_size=DB_READ_POOL_SIZE, max_overflow=DB_READ_POOL_SIZE)
+    # SQLite allows one writer at a time, so the writers of a process queue
+    # for the connection instead of for the database lock.
+    return dict(
+        pool_size=DB_WRITE_POOL_SIZE, max_overflow=0, pool_timeout=DB_BUSY_TIMEOUT
+    )
+
+
+def _configure_sqlite(engine: sqlalchemy.Engine, readonly: bool):
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # The driver must not begin transactions itself, see begin below.
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        if not readonly:
+            # With WAL, readers neither block nor get blocked by the writer.
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size={-DB_CACHE_SIZE}")
+        cursor.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        if readonly:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    @sqlalchemy.event.listens_for(engine, "begin")
+    def begin(connection):
+        # A write transaction takes the lock up front. Upgrading a read
+        # transaction fails right away if another connection wrote meanwhile,
+        # instead of waiting for the busy timeout.
+        connection.exec_driver_sql("BEGIN" if readonly else "BEGIN IMMEDIATE")
+
+
+def create_engine(url: str = DATABASE_URL, readonly: bool = False) -> sqlalchemy.Engine:
+    """Create an engine for reading or for writing to the database"""
+    url = sqlalchemy.make_url(url)
+    engine = sqlalchemy.create_engine(url, echo=False, **_pool_options(url, readonly))
+    if engine.dialect.name == "sqlite":
+        _configure_sqlite(engine, readonly)
+    metrics.instrument_engine(engine)
+    return engine
+
+
+def create_async_engine(url: str = DATABASE_URL, readonly: bool = False) -> AsyncEngine:
+    url = sqlalchemy.make_url(url)
+    if url.drivername in ("sqlite", "sqlite+pysqlite"):
+        url = url.set(drivername="sqlite+aiosqlite")
+    engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url, echo=False, **_pool_options(url, readonly)
+    )
+    if engine.dialect.name == "sqlite":
+        _configure_sqlite(engine.sync_engine, readonly)
+    metrics.instrument_engine(engine.sync_engine)
+    return engine
+
+
+# The writers are also used for the reads that are part of a write.
+engine = create_engine()
+read_engine = create_engine(readonly=True)
+async_engine = create_async_engine()
+async_read_engine = create_async_engine(readonly=True)
 
 
 class Base(sqlalchemy.orm.DeclarativeBase):
@@ -20,6 +115,8 @@ class User(Base):
     name: Mapped[str]
     password: Mapped[str]
 
+    __table_args__ = (sqlalchemy.Index("ix_users_name", "name", unique=True),)
+
 
 class Bill(Base):
     __tablename__ = "bills"
@@ -28,6 +125,25 @@ class Bill(Base):
     datetime: Mapped[datetime.datetime]
     value: Mapped[float]
     file_hash: Mapped[str]
+    expenses: Mapped[List["Expense"]] = relationship(back_populates="bill")
+
+    __table_args__ = (
+        sqlalchemy.Index("ix_bills_user_id_file_hash", "user_id", "file_hash"),
+        sqlalchemy.Index("ix_bills_user_id_datetime", "user_id", "datetime"),
+    )
+
+
+class Product(Base):
+    """A distinct expense name of a user"""
+
+    __tablename__ = "products"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    name: Mapped[str]
+
+    __table_args__ = (
+        sqlalchemy.Index("ix_products_user_id_name", "user_id", "name", unique=True),
+    )
 
 
 class Expense(Base):
@@ -35,7 +151,9 @@ class Expense(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     bill_id: Mapped[int] = mapped_column(ForeignKey("bills.id"))
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # The name is kept next to the product for the existing API responses.
     name: Mapped[str]
+    product_id: Mapped[Optional[int]] = mapped_column(ForeignKey("products.id"))
     value: Mapped[float]
     quantity: Mapped[int] = mapped_column(default=1)
     price_per_item: Mapped[Optional[float]]
@@ -43,6 +161,25 @@ class Expense(Base):
     price_per_kg: Mapped[Optional[float]]
     tags: Mapped[Optional[str]]
     datetime: Mapped[datetime.datetime]
+    bill: Mapped[Bill] = relationship(back_populates="expenses")
+
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_expenses_user_id_datetime_name", "user_id", "datetime", "name"
+        ),
+        sqlalchemy.Index("ix_expenses_bill_id", "bill_id"),
+        # Covers the price history of a product.
+        sqlalchemy.Index(
+            "ix_expenses_product_id_datetime_prices",
+            "product_id",
+            "datetime",
+            "value",
+            "quantity",
+            "price_per_item",
+            "weight",
+            "price_per_kg",
+        ),
+    )
 
     def __repr__(self):
         return (
@@ -56,126 +193,1201 @@ class Expense(Base):
         )
 
 
-def create_database():
-    Base.metadata.create_all(engine)
+class DailyTotal(Base):
+    """Sum of all bills of a user on one day"""
+
+    __tablename__ = "daily_totals"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    day: Mapped[datetime.date] = mapped_column(primary_key=True)
+    value: Mapped[float]
+
+
+class DailyProductTotal(Base):
+    """Sum of all expenses of a user for one product on one day"""
+
+    __tablename__ = "daily_product_totals"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    day: Mapped[datetime.date] = mapped_column(primary_key=True)
+    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), primary_key=True)
+    value: Mapped[float]
+
+
+class Job(Base):
+    """An uploaded eBon waiting to be parsed and stored"""
+
+    __tablename__ = "jobs"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    # queued, running, done or failed
+    status: Mapped[str] = mapped_column(default="queued")
+    file_name: Mapped[Optional[str]]
+    file_hash: Mapped[str]
+    # The eBon is dropped once the job is finished.
+    ebon: Mapped[Optional[bytes]] = mapped_column(deferred=True)
+    bill_id: Mapped[Optional[int]] = mapped_column(ForeignKey("bills.id"))
+    error: Mapped[Optional[str]]
+    created: Mapped[datetime.datetime]
+    updated: Mapped[datetime.datetime]
+
+    __table_args__ = (
+        sqlalchemy.Index("ix_jobs_status_id", "status", "id"),
+        sqlalchemy.Index("ix_jobs_user_id_id", "user_id", "id"),
+    )
+
+
+class ProductPrice(Base):
+    """First and last unit price of a product, updated with every new bill
+
+    Prices per kg and per item are separate series, they do not compare.
+    """
+
+    __tablename__ = "product_prices"
+    product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), primary_key=True)
+    per_kg: Mapped[bool] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
+    first_datetime: Mapped[datetime.datetime]
+    first_price: Mapped[float]
+    last_datetime: Mapped[datetime.datetime]
+    last_price: Mapped[float]
+    count: Mapped[int]
+
+    __table_args__ = (sqlalchemy.Index("ix_product_prices_user_id", "user_id"),)
+
+
+class UserUpdate(Base):
+    """When the bills and rollups of a user last changed
+
+    Any process storing bills updates it, so the chart cache of the API notices
+    bills added by the command line scripts.
+    """
+
+    __tablename__ = "user_updates"
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    updated: Mapped[datetime.datetime]
+
+
+class SchemaVersion(Base):
+    """Number of migrations applied to the database"""
+
+    __tablename__ = "schema_version"
+    version: Mapped[int] = mapped_column(primary_key=True)
+
+
+def _create_indexes(connection: sqlalchemy.Connection, *names: str):
+    # create_all skips the indexes of tables that already exist.
+    indexes = {
+        index.name: index
+        for table in Base.metadata.sorted_tables
+        for index in table.indexes
+    }
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+def _add_column(connection: sqlalchemy.Connection, table: str, column: str):
+    """Add a column of the model to an existing table"""
+    existing = {c["name"] for c in sqlalchemy.inspect(connection).get_columns(table)}
+    if column in existing:
+        return
+    column_ = Base.metadata.tables[table].columns[column]
+    type_ = column_.type.compile(connection.dialect)
+    connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {type_}")
+
+
+def _migrate_1(connection: sqlalchemy.Connection):
+    # Not from the model, the name index only became unique with migration 5,
+    # which first renames the users sharing a name.
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_users_name ON users (name)"
+    )
+    _create_indexes(
+        connection,
+        "ix_bills_user_id_file_hash",
+        "ix_bills_user_id_datetime",
+        "ix_expenses_user_id_datetime_name",
+        "ix_expenses_bill_id",
+        "ix_jobs_status_id",
+        "ix_jobs_user_id_id",
+    )
+
+
+def _migrate_2(connection: sqlalchemy.Connection):
+    # Products are interned from the expense names of every user.
+    _add_column(connection, "expenses", "product_id")
+    _create_indexes(connection, "ix_products_user_id_name")
+    connection.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_expenses_product_id ON expenses (product_id)"
+    )
+    names = sqlalchemy.select(Expense.user_id, Expense.name).distinct()
+    connection.execute(
+        sqlalchemy.insert(Product)
+        .from_select(["user_id", "name"], names)
+        .prefix_with("OR IGNORE")
+    )
+    product_id = (
+        sqlalchemy.select(Product.id)
+        .where(Product.user_id == Expense.user_id, Product.name == Expense.name)
+        .scalar_subquery()
+    )
+    connection.execute(
+        sqlalchemy.update(Expense)
+        .where(Expense.product_id.is_(None))
+        .values(product_id=product_id)
+    )
+    # The product totals were keyed by name, they are recomputed by product.
+    columns = {
+        c["name"]
+        for c in sqlalchemy.inspect(connection).get_columns("daily_product_totals")
+    }
+    if "product_id" not in columns:
+        DailyProductTotal.__table__.drop(connection)
+        DailyProductTotal.__table__.create(connection)
+        connection.execute(
+            sqlalchemy.insert(DailyProductTotal).from_select(
+                ["user_id", "day", "product_id", "value"], _sum_daily_products()
+            )
+        )
+
+
+def _migrate_3(connection: sqlalchemy.Connection):
+    # Full text index of the product names. The trigram tokenizer matches
+    # any substring of at least three characters, case insensitive.
+    if connection.dialect.name != "sqlite":
+        return
+    connection.exec_driver_sql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5("
+        "name, content='products', content_rowid='id', tokenize='trigram')"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products "
+        "BEGIN INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name); END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products "
+        "BEGIN INSERT INTO products_fts(products_fts, rowid, name) "
+        "VALUES ('delete', old.id, old.name); END"
+    )
+    connection.exec_driver_sql(
+        "CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products "
+        "BEGIN INSERT INTO products_fts(products_fts, rowid, name) "
+        "VALUES ('delete', old.id, old.name); "
+        "INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name); END"
+    )
+    connection.exec_driver_sql(
+        "INSERT INTO products_fts(products_fts) VALUES ('rebuild')"
+    )
+
+
+def _migrate_4(connection: sqlalchemy.Connection):
+    # The price index starts with the product id, so it replaces the index on
+    # the product id alone.
+    _create_indexes(
+        connection,
+        "ix_expenses_product_id_datetime_prices",
+        "ix_product_prices_user_id",
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_expenses_product_id")
+    _rebuild_product_prices(connection)
+
+
+def _migrate_5(connection: sqlalchemy.Connection):
+    # Concurrent registrations could create several users of the same name.
+    # All but the first one are renamed to "name#id", so the name index can be
+    # unique; they keep their bills, but have to log in with the new name.
+    first_ids = sqlalchemy.select(sqlalchemy.func.min(User.id)).group_by(User.name)
+    connection.execute(
+        sqlalchemy.update(User)
+        .where(User.id.not_in(first_ids))
+        .values(name=User.name + "#" + sqlalchemy.cast(User.id, sqlalchemy.String))
+    )
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_users_name")
+    _create_indexes(connection, "ix_users_name")
+
+
+def _migrate_6(connection: sqlalchemy.Connection):
+    # create_all adds the rollup tables empty to databases that predate them,
+    # they are filled from the bills before the charts are served.
+    has_bills = connection.scalar(sqlalchemy.select(Bill.id).limit(1)) is not None
+    has_rollups = (
+        connection.scalar(sqlalchemy.select(DailyTotal.user_id).limit(1)) is not None
+    )
+    if has_bills and not has_rollups:
+        _rebuild_rollups(connection)
+
+
+def _migrate_7(connection: sqlalchemy.Connection):
+    # The price summaries are kept per product and unit, the primary key of
+    # the table changes, so it is created again.
+    primary_key = sqlalchemy.inspect(connection).get_pk_constraint("product_prices")
+    if "per_kg" not in primary_key["constrained_columns"]:
+        ProductPrice.__table__.drop(connection)
+        ProductPrice.__table__.create(connection)
+        _rebuild_product_prices(connection)
+
+
+# Every migration must also work on a database just created by create_all,
+# i.e. skip what exists already. Migrations are only ever appended.
+MIGRATIONS = [
+    _migrate_1,
+    _migrate_2,
+    _migrate_3,
+    _migrate_4,
+    _migrate_5,
+    _migrate_6,
+    _migrate_7,
+]
+
+
+def migrate(bind: Optional[sqlalchemy.Engine] = None) -> int:
+    """Apply the migrations missing in the database, returns the new version"""
+    bind = engine if bind is None else bind
+    with bind.begin() as connection:
+        version = connection.scalar(sqlalchemy.select(SchemaVersion.version)) or 0
+        for migration in MIGRATIONS[version:]:
+            migration(connection)
+        connection.execute(sqlalchemy.delete(SchemaVersion))
+        connection.execute(
+            sqlalchemy.insert(SchemaVersion).values(version=len(MIGRATIONS))
+        )
+    return len(MIGRATIONS)
+
+
+def create_database(bind: Optional[sqlalchemy.Engine] = None):
+    bind = engine if bind is None else bind
+    Base.metadata.create_all(bind)
+    migrate(bind)
 
 
 def clean():
     Base.metadata.drop_all(engine)
 
 
-def orm_object_to_dict(expense: Expense):
-    d = expense.__dict__
-    d.pop("_sa_instance_state")
-    return d
+# Product ids by (user id, name). Only committed products are cached, new ones
+# are cached once they are looked up by a later eBon.
+_product_ids: dict[tuple[int, str], int] = {}
+_product_ids_schema = None
+
+
+def _check_product_cache(session: sqlalchemy.orm.Session):
+    # Resetting the database recreates the tables, which changes the schema
+    # version. The cached ids would point to products that no longer exist.
+    global _product_ids_schema
+    if session.get_bind().dialect.name != "sqlite":
+        return
+    schema = session.execute(sqlalchemy.text("PRAGMA schema_version")).scalar()
+    if schema != _product_ids_schema:
+        _product_ids.clear()
+        _product_ids_schema = schema
+
+
+def intern_products(
+    session: sqlalchemy.orm.Session, user_id: int, names: set[str]
+) -> dict[str, int]:
+    """Return the product ids of the names, adding the missing products"""
+    _check_product_cache(session)
+    ids = {}
+    for name in names:
+        product_id = _product_ids.get((user_id, name))
+        if product_id is not None:
+            ids[name] = product_id
+    missing = [name for name in names if name not in ids]
+    for i in range(0, len(missing), HASH_CHUNK_SIZE):
+        query = sqlalchemy.select(Product.name, Product.id).where(
+            Product.user_id == user_id,
+            Product.name.in_(missing[i : i + HASH_CHUNK_SIZE]),
+        )
+        for name, product_id in session.execute(query):
+            ids[name] = product_id
+            if len(_product_ids) >= PRODUCT_CACHE_SIZE:
+                _product_ids.clear()
+            _product_ids[(user_id, name)] = product_id
+    new = [name for name in missing if name not in ids]
+    if new:
+        # An ordered RETURNING would insert the products one by one, their ids
+        # are selected by name afterwards.
+        session.execute(
+            sqlalchemy.insert(Product),
+            [dict(user_id=user_id, name=name) for name in new],
+        )
+        for i in range(0, len(new), HASH_CHUNK_SIZE):
+            query = sqlalchemy.select(Product.name, Product.id).where(
+                Product.user_id == user_id,
+                Product.name.in_(new[i : i + HASH_CHUNK_SIZE]),
+            )
+            ids.update(session.execute(query).all())
+    return ids
+
+
+def _add_to_rollup(
+    session: sqlalchemy.orm.Session,
+    table: type[DailyTotal] | type[DailyProductTotal],
+    increments: dict[tuple, float],
+):
+    # The rollup rows of the affected users and days are loaded at once. The
+    # product names are matched in Python, there are only a few rows per day.
+    user_ids = {key[0] for key in increments}
+    days = {key[1] for key in increments}
+    query = (
+        sqlalchemy.select(table)
+        .where(table.user_id.in_(user_ids))
+        .where(table.day.in_(days))
+    )
+    key_names = [column.key for column in table.__table__.primary_key.columns]
+    rows = {
+        tuple(getattr(row, name) for name in key_names): row
+        for row in session.scalars(query)
+    }
+    for key, value in increments.items():
+        row = rows.get(key)
+        if row is None:
+            row = table(**dict(zip(key_names, key)), value=0)
+            session.add(row)
+        row.value += value
+
+
+def add_to_rollups(
+    session: sqlalchemy.orm.Session, bills: List[Bill], expenses: List[Expense]
+):
+    """Add new bills and their expenses to the daily rollup tables
+
+    This only stages the changes, the caller commits them together with the bills.
+    """
+    daily = collections.defaultdict(float)
+    for bill in bills:
+        daily[(bill.user_id, bill.datetime.date())] += bill.value
+    daily_products = collections.defaultdict(float)
+    for expense in expenses:
+        key = (expense.user_id, expense.datetime.date(), expense.product_id)
+        daily_products[key] += expense.value
+    if daily:
+        _add_to_rollup(session, DailyTotal, daily)
+    if daily_products:
+        _add_to_rollup(session, DailyProductTotal, daily_products)
+    if expenses:
+        _add_to_product_prices(session, expenses)
+    if bills:
+        _touch_users(session, {bill.user_id for bill in bills})
+
+
+def _touch_users(
+    connection: sqlalchemy.Connection | sqlalchemy.orm.Session,
+    user_ids: Optional[set[int]] = None,
+):
+    # A timestamp and not a counter, so it does not repeat when the database
+    # is recreated while the API keeps its cache.
+    users = sqlalchemy.select(User.id, sqlalchemy.literal(datetime.datetime.now()))
+    delete = sqlalchemy.delete(UserUpdate)
+    if user_ids is not None:
+        users = users.where(User.id.in_(user_ids))
+        delete = delete.where(UserUpdate.user_id.in_(user_ids))
+    connection.execute(delete)
+    connection.execute(
+        sqlalchemy.insert(UserUpdate).from_select(["user_id", "updated"], users)
+    )
+
+
+def unit_price(
+    value: float,
+    quantity: Optional[int],
+    price_per_item: Optional[float],
+    weight: Optional[float],
+    price_per_kg: Optional[float],
+) -> tuple[float, bool]:
+    """Return the price per kg if the weight is known, otherwise per item"""
+    if price_per_kg is not None:
+        return price_per_kg, True
+    if weight:
+        return value / weight, True
+    if price_per_item is not None:
+        return price_per_item, False
+    return value / (quantity or 1), False
+
+
+_PRICE_COLUMNS = (
+    Expense.value,
+    Expense.quantity,
+    Expense.price_per_item,
+    Expense.weight,
+    Expense.price_per_kg,
+)
+
+
+def _merge_price(summary: ProductPrice, other: ProductPrice):
+    if other.first_datetime < summary.first_datetime:
+        summary.first_datetime = other.first_datetime
+        summary.first_price = other.first_price
+    if other.last_datetime >= summary.last_datetime:
+        summary.last_datetime = other.last_datetime
+        summary.last_price = other.last_price
+    summary.count += other.count
+
 
+def _summarize_prices(rows) -> dict[tuple[int, bool], ProductPrice]:
+    """Fold (product id, user id, datetime, price, per kg) into one row per series
 
-def register(user_name: str, password: str):
-    hash_ = bcrypt.hash(password)
+    Of several rows with the same datetime, e.g. a product bought twice on a
+    bill, the first row gives the first price and the last row the last one,
+    so they have to be ordered by expense id.
+    """
+    summaries = {}
+    for product_id, user_id, datetime_, price, per_kg in rows:
+        summary = ProductPrice(
+            product_id=product_id,
+            user_id=user_id,
+            per_kg=per_kg,
+            first_datetime=datetime_,
+            first_price=price,
+            last_datetime=datetime_,
+            last_price=price,
+            count=1,
+        )
+        key = (product_id, per_kg)
+        if key in summaries:
+            _merge_price(summaries[key], summary)
+        else:
+            summaries[key] = summary
+    return summaries
+
+
+def _add_to_product_prices(session: sqlalchemy.orm.Session, expenses: List[Expense]):
+    summaries = _summarize_prices(
+        (
+            e.product_id,
+            e.user_id,
+            e.datetime,
+            *unit_price(
+                e.value, e.quantity, e.price_per_item, e.weight, e.price_per_kg
+            ),
+        )
+        for e in expenses
+    )
+    product_ids = {product_id for product_id, _ in summaries}
+    query = sqlalchemy.select(ProductPrice).where(
+        ProductPrice.product_id.in_(product_ids)
+    )
+    rows = {(row.product_id, row.per_kg): row for row in session.scalars(query)}
+    for key, summary in summaries.items():
+        row = rows.get(key)
+        if row is None:
+            session.add(summary)
+        else:
+            _merge_price(row, summary)
+
+
+def _rebuild_product_prices(
+    connection: sqlalchemy.Connection | sqlalchemy.orm.Session,
+    user_id: Optional[int] = None,
+):
+    delete = sqlalchemy.delete(ProductPrice)
+    query = (
+        sqlalchemy.select(
+            Expense.product_id, Expense.user_id, Expense.datetime, *_PRICE_COLUMNS
+        )
+        .where(Expense.product_id.is_not(None))
+        # The datetime of an expense is the one of its bill.
+        .order_by(Expense.product_id, Expense.datetime, Expense.id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    if user_id is not None:
+        delete = delete.where(ProductPrice.user_id == user_id)
+        query = query.where(Expense.user_id == user_id)
+    connection.execute(delete)
+    rows = connection.execute(query)
+    summaries = _summarize_prices(
+        (product_id, user_id_, datetime_, *unit_price(*prices))
+        for product_id, user_id_, datetime_, *prices in rows
+    )
+    if summaries:
+        connection.execute(
+            sqlalchemy.insert(ProductPrice),
+            [orm_object_to_dict(summary) for summary in summaries.values()],
+        )
+
+
+def _sum_daily_products():
+    expense_day = sqlalchemy.func.date(Expense.datetime)
+    return sqlalchemy.select(
+        Expense.user_id,
+        expense_day,
+        Expense.product_id,
+        sqlalchemy.func.sum(Expense.value),
+    ).group_by(Expense.user_id, expense_day, Expense.product_id)
+
+
+def _rebuild_rollups(
+    connection: sqlalchemy.Connection | sqlalchemy.orm.Session,
+    user_id: Optional[int] = None,
+):
+    bill_day = sqlalchemy.func.date(Bill.datetime)
+    daily = sqlalchemy.select(
+        Bill.user_id, bill_day, sqlalchemy.func.sum(Bill.value)
+    ).group_by(Bill.user_id, bill_day)
+    daily_products = _sum_daily_products()
+    delete_daily = sqlalchemy.delete(DailyTotal)
+    delete_daily_products = sqlalchemy.delete(DailyProductTotal)
+    if user_id is not None:
+        daily = daily.where(Bill.user_id == user_id)
+        daily_products = daily_products.where(Expense.user_id == user_id)
+        delete_daily = delete_daily.where(DailyTotal.user_id == user_id)
+        delete_daily_products = delete_daily_products.where(
+            DailyProductTotal.user_id == user_id
+        )
+    connection.execute(delete_daily)
+    connection.execute(delete_daily_products)
+    connection.execute(
+        sqlalchemy.insert(DailyTotal).from_select(["user_id", "day", "value"], daily)
+    )
+    connection.execute(
+        sqlalchemy.insert(DailyProductTotal).from_select(
+            ["user_id", "day", "product_id", "value"], daily_products
+        )
+    )
+    _rebuild_product_prices(connection, user_id)
+    _touch_users(connection, None if user_id is None else {user_id})
+
+
+def rebuild_rollups(user_id: Optional[int] = None):
+    """Recompute the rollup tables from the bills and expenses"""
     with sqlalchemy.orm.Session(engine) as session:
-        user = User(name=user_name, password=hash_)
-        session.add(user)
+        _rebuild_rollups(session, user_id)
         session.commit()
 
 
-def find_user(user_name: str, password: str = None):
-    with sqlalchemy.orm.Session(engine) as session:
-        results = session.query(User).filter(User.name == user_name).all()
-        if not results:
-            return None
-        assert len(results) == 1
-        user = results[0]
-        if password is not None and not bcrypt.verify(password, user.password):
+def orm_object_to_dict(obj: Base):
+    return {column.key: getattr(obj, column.key) for column in obj.__table__.columns}
+
+
+async def register_async(user_name: str, password: str) -> User | None:
+    """Add a user, returns None if the name is taken"""
+    hash_ = await passwords.hash(password)
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        user = User(name=user_name, password=hash_)
+        session.add(user)
+        try:
+            await session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # Another registration of the name won the race.
             return None
+    return user
+
+
+def _check_user(results: List[User]) -> User | None:
+    if not results:
+        return None
+    assert len(results) == 1
+    return results[0]
+
+
+def _update_password(user: User, hash_: str):
+    return sqlalchemy.update(User).where(User.id == user.id).values(password=hash_)
+
+
+def _select_user_by_name(user_name: str):
+    return sqlalchemy.select(User).where(User.name == user_name)
+
+
+def find_user(user_name: str) -> User | None:
+    """Return the user of a name, for the command line scripts"""
+    query = _select_user_by_name(user_name)
+    with sqlalchemy.orm.Session(read_engine) as session:
+        return _check_user(session.scalars(query).all())
+
+
+async def find_user_async(user_name: str, password: str = None):
+    query = _select_user_by_name(user_name)
+    async with AsyncSession(async_read_engine) as session:
+        user = _check_user((await session.scalars(query)).all())
+    if user is None or password is None:
         return user
+    # Outdated hashes, e.g. with fewer bcrypt rounds, are replaced on login.
+    valid, new_hash = await passwords.verify_and_update(password, user.password)
+    if not valid:
+        return None
+    if new_hash is not None:
+        async with AsyncSession(async_engine) as session:
+            await session.execute(_update_password(user, new_hash))
+            await session.commit()
+    return user
 
 
-def find_bill_by_hash(user: User, hash: str) -> Bill | None:
-    with sqlalchemy.orm.Session(engine) as session:
-        results = (
-            session.query(Bill)
-            .filter(Bill.user_id == user.id)
-            .filter(Bill.file_hash == hash)
-            .all()
+async def get_user_async(user_id: int) -> User | None:
+    async with AsyncSession(async_read_engine) as session:
+        return await session.get(User, user_id)
+
+
+async def get_user_updated_async(user: User) -> datetime.datetime | None:
+    """Return when the bills of a user last changed, None if never"""
+    async with AsyncSession(async_read_engine) as session:
+        return await session.scalar(
+            sqlalchemy.select(UserUpdate.updated).where(UserUpdate.user_id == user.id)
         )
-        if not results:
-            return None
-        assert len(results) == 1
-        bill = results[0]
-        return bill
 
 
-def jsonify_bill(bill: Bill = None, bill_id: int = None):
-    with sqlalchemy.orm.Session(engine) as session:
-        if bill_id is None:
-            assert bill is not None
-        else:
-            query = session.query(Bill).filter(Bill.id == bill_id)
-            results = query.all()
-            assert len(results) == 1
-            bill = results[0]
-    with sqlalchemy.orm.Session(engine) as session:
-        query = session.query(Expense).filter(Expense.bill_id == bill.id)
-        expenses = [orm_object_to_dict(e) for e in query.all()]
-        return dict(**orm_object_to_dict(bill), expenses=expenses)
+def _select_bill_by_hash(user: User, hash: str):
+    return (
+        sqlalchemy.select(Bill)
+        .where(Bill.user_id == user.id)
+        .where(Bill.file_hash == hash)
+    )
 
 
-def get_bills(user: User, limit: Optional[int] = None) -> List[Bill]:
-    with sqlalchemy.orm.Session(engine) as session:
-        query = (
-            session.query(Bill)
-            .filter(Bill.user_id == user.id)
-            .order_by(Bill.datetime.desc())
-            .limit(limit)
+def _check_bill(results: List[Bill]) -> Bill | None:
+    if not results:
+        return None
+    assert len(results) == 1
+    return results[0]
+
+
+async def find_bill_by_hash_async(user: User, hash: str) -> Bill | None:
+    async with AsyncSession(async_read_engine) as session:
+        results = (await session.scalars(_select_bill_by_hash(user, hash))).all()
+    return _check_bill(results)
+
+
+def _select_bill_ids_by_hashes(user: User, hashes: List[str]):
+    return (
+        sqlalchemy.select(Bill.file_hash, Bill.id)
+        .where(Bill.user_id == user.id)
+        .where(Bill.file_hash.in_(hashes))
+    )
+
+
+def find_bill_ids_by_hashes(user: User, hashes: List[str]) -> dict[str, int]:
+    """Return the ids of the user's bills with the given hashes by hash"""
+    ids = {}
+    with sqlalchemy.orm.Session(read_engine) as session:
+        for i in range(0, len(hashes), HASH_CHUNK_SIZE):
+            query = _select_bill_ids_by_hashes(user, hashes[i : i + HASH_CHUNK_SIZE])
+            ids.update(session.execute(query).all())
+    return ids
+
+
+async def find_bill_ids_by_hashes_async(
+    user: User, hashes: List[str]
+) -> dict[str, int]:
+    ids = {}
+    async with AsyncSession(async_read_engine) as session:
+        for i in range(0, len(hashes), HASH_CHUNK_SIZE):
+            query = _select_bill_ids_by_hashes(user, hashes[i : i + HASH_CHUNK_SIZE])
+            ids.update((await session.execute(query)).all())
+    return ids
+
+
+def find_missing_hashes(user: User, hashes: List[str]) -> List[str]:
+    """Return the hashes for which the user has no bill yet"""
+    known = find_bill_ids_by_hashes(user, hashes)
+    return [hash for hash in hashes if hash not in known]
+
+
+async def find_missing_hashes_async(user: User, hashes: List[str]) -> List[str]:
+    known = await find_bill_ids_by_hashes_async(user, hashes)
+    return [hash for hash in hashes if hash not in known]
+
+
+def _select_bill(user: User, bill_id: int):
+    return (
+        sqlalchemy.select(Bill)
+        .where(Bill.id == bill_id)
+        .where(Bill.user_id == user.id)
+        .options(sqlalchemy.orm.selectinload(Bill.expenses))
+    )
+
+
+def jsonify_bill(user: User, bill: Bill = None, bill_id: int = None):
+    """Convert a bill of the user and its expenses to a dict
+
+    A given bill must have its expenses loaded already.
+    """
+    if bill_id is not None:
+        with sqlalchemy.orm.Session(read_engine) as session:
+            bill = session.scalars(_select_bill(user, bill_id)).one()
+    assert bill is not None and bill.user_id == user.id
+    expenses = [orm_object_to_dict(e) for e in bill.expenses]
+    return dict(**orm_object_to_dict(bill), expenses=expenses)
+
+
+async def jsonify_bill_async(user: User, bill: Bill = None, bill_id: int = None):
+    if bill_id is not None:
+        async with AsyncSession(async_read_engine) as session:
+            bill = (await session.scalars(_select_bill(user, bill_id))).one()
+    return jsonify_bill(user, bill)
+
+
+def _page_bills(
+    query,
+    user: User,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime.datetime, int]] = None,
+):
+    # Bills are paginated by (datetime, id), newest first.
+    query = (
+        query.where(Bill.user_id == user.id)
+        .order_by(Bill.datetime.desc(), Bill.id.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        before_datetime, before_id = before
+        query = query.where(
+            sqlalchemy.or_(
+                Bill.datetime < before_datetime,
+                sqlalchemy.and_(Bill.datetime == before_datetime, Bill.id < before_id),
+            )
         )
-        bills = query.all()
+    return query
+
+
+def _select_bill_rows(
+    user: User,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime.datetime, int]] = None,
+):
+    query = sqlalchemy.select(*Bill.__table__.columns)
+    return _page_bills(query, user, limit, before)
 
+
+def _select_expense_rows(bill_ids: List[int]):
+    return (
+        sqlalchemy.select(*Expense.__table__.columns)
+        .where(Expense.bill_id.in_(bill_ids))
+        .order_by(Expense.id)
+    )
+
+
+def _bill_dicts(bill_rows, expense_rows) -> List[dict]:
+    bills = [row._asdict() for row in bill_rows]
+    expenses = collections.defaultdict(list)
+    for row in expense_rows:
+        expenses[row.bill_id].append(row._asdict())
+    for bill in bills:
+        bill["expenses"] = expenses[bill["id"]]
     return bills
 
 
-def retrieve_sum_expenses(
+async def get_bill_dicts_async(
     user: User,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime.datetime, int]] = None,
+) -> List[dict]:
+    """Return the bills older than the (datetime, id) before as jsonify_bill dicts
+
+    The dicts are built from column tuples, skipping the ORM objects which
+    would only be read and thrown away when listing bills.
+    """
+    async with AsyncSession(async_read_engine) as session:
+        bills = (await session.execute(_select_bill_rows(user, limit, before))).all()
+        bill_ids = [bill.id for bill in bills]
+        expenses = (await session.execute(_select_expense_rows(bill_ids))).all()
+    return _bill_dicts(bills, expenses)
+
+
+def _select_bill_hashes(user: User):
+    return sqlalchemy.select(Bill.file_hash).where(Bill.user_id == user.id)
+
+
+def get_bill_hashes(user: User) -> List[str]:
+    with sqlalchemy.orm.Session(read_engine) as session:
+        hashes = session.scalars(_select_bill_hashes(user)).all()
+    return hashes
+
+
+async def get_bill_hashes_async(user: User) -> List[str]:
+    async with AsyncSession(async_read_engine) as session:
+        hashes = (await session.scalars(_select_bill_hashes(user))).all()
+    return hashes
+
+
+def export_columns(table: type[Bill] | type[Expense]) -> List[str]:
+    return [column.key for column in table.__table__.columns]
+
+
+def _select_export(
+    table: type[Bill] | type[Expense],
+    user: User,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+):
+    query = (
+        sqlalchemy.select(*table.__table__.columns)
+        .where(table.user_id == user.id)
+        .order_by(table.datetime, table.id)
+    )
+    if start is not None:
+        start = datetime.datetime.combine(start, datetime.time())
+        query = query.where(table.datetime >= start)
+    if stop is not None:
+        stop = datetime.datetime.combine(stop, datetime.time())
+        query = query.where(table.datetime < stop + datetime.timedelta(days=1))
+    return query
+
+
+def export_rows(
+    table: type[Bill] | type[Expense],
+    user: User,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+):
+    """Yield the user's bills or expenses from start to stop (inclusive)
+
+    The rows are plain tuples in the order of export_columns, fetched in
+    chunks, so the memory use does not depend on the number of rows.
+    """
+    query = _select_export(table, user, start, stop).execution_options(
+        yield_per=EXPORT_CHUNK_SIZE
+    )
+    with sqlalchemy.orm.Session(read_engine) as session:
+        for partition in session.execute(query).partitions():
+            yield from partition
+
+
+products_fts = sqlalchemy.table(
+    "products_fts", sqlalchemy.column("rowid"), sqlalchemy.column("name")
+)
+
+
+def _select_matching_products(user: User, text: str):
+    if len(text) < 3:
+        # The trigram index needs at least three characters.
+        condition = Product.name.icontains(text, autoescape=True)
+        return sqlalchemy.select(Product.id).where(
+            Product.user_id == user.id, condition
+        )
+    phrase = '"' + text.replace('"', '""') + '"'
+    return (
+        sqlalchemy.select(Product.id)
+        .join(products_fts, products_fts.c.rowid == Product.id)
+        .where(Product.user_id == user.id)
+        .where(sqlalchemy.literal_column("products_fts").op("MATCH")(phrase))
+    )
+
+
+def _select_product_names(user: User):
+    return sqlalchemy.select(Product.id, Product.name).where(Product.user_id == user.id)
+
+
+def _close_matches(text: str, products) -> List[int]:
+    # Typos are matched against the names of the user's products, there are
+    # a few thousand at most.
+    ids = {}
+    for product_id, name in products:
+        ids.setdefault(name.lower(), []).append(product_id)
+    matches = difflib.get_close_matches(text.lower(), ids, n=SEARCH_FUZZY_MATCHES)
+    return [product_id for name in matches for product_id in ids[name]]
+
+
+def _select_expenses_of_products(
+    user: User,
+    product_ids: sqlalchemy.Select | List[int],
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime.datetime, int]] = None,
+):
+    query = (
+        sqlalchemy.select(*Expense.__table__.columns)
+        .where(Expense.user_id == user.id)
+        .where(Expense.product_id.in_(product_ids))
+        .order_by(Expense.datetime.desc(), Expense.id.desc())
+        .limit(limit)
+    )
+    if start is not None:
+        start = datetime.datetime.combine(start, datetime.time())
+        query = query.where(Expense.datetime >= start)
+    if stop is not None:
+        stop = datetime.datetime.combine(stop, datetime.time())
+        query = query.where(Expense.datetime < stop + datetime.timedelta(days=1))
+    if before is not None:
+        before_datetime, before_id = before
+        query = query.where(
+            sqlalchemy.or_(
+                Expense.datetime < before_datetime,
+                sqlalchemy.and_(
+                    Expense.datetime == before_datetime, Expense.id < before_id
+                ),
+            )
+        )
+    return query
+
+
+async def search_expenses_async(
+    user: User,
+    text: str,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+    limit: Optional[int] = None,
+    before: Optional[tuple[datetime.datetime, int]] = None,
+) -> List[dict]:
+    """Return the user's expenses whose name contains the text, newest first
+
+    If no name contains the text, the names closest to it are used instead.
+    """
+    async with AsyncSession(async_read_engine) as session:
+        # The matching products are a subquery, a common text matches too
+        # many of them for a list of ids.
+        matching = _select_matching_products(user, text)
+        query = _select_expenses_of_products(user, matching, start, stop, limit, before)
+        rows = (await session.execute(query)).all()
+        if not rows and (await session.scalar(matching.limit(1))) is None:
+            products = await session.execute(_select_product_names(user))
+            product_ids = _close_matches(text, products)
+            if not product_ids:
+                return []
+            query = _select_expenses_of_products(
+                user, product_ids, start, stop, limit, before
+            )
+            rows = (await session.execute(query)).all()
+    return [row._asdict() for row in rows]
+
+
+def _select_product(user: User, name: str):
+    return sqlalchemy.select(Product.id).where(
+        Product.user_id == user.id, Product.name == name
+    )
+
+
+def _select_prices(
+    product_id: int,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+):
+    # Only reads the columns of ix_expenses_product_id_datetime_prices.
+    query = (
+        sqlalchemy.select(Expense.datetime, *_PRICE_COLUMNS)
+        .where(Expense.product_id == product_id)
+        .order_by(Expense.datetime)
+    )
+    if start is not None:
+        start = datetime.datetime.combine(start, datetime.time())
+        query = query.where(Expense.datetime >= start)
+    if stop is not None:
+        stop = datetime.datetime.combine(stop, datetime.time())
+        query = query.where(Expense.datetime < stop + datetime.timedelta(days=1))
+    return query
+
+
+async def get_price_history_async(
+    user: User,
+    name: str,
+    start: Optional[datetime.date] = None,
+    stop: Optional[datetime.date] = None,
+) -> Optional[List[dict]]:
+    """Return the unit prices a user paid for a product, None if unknown"""
+    async with AsyncSession(async_read_engine) as session:
+        product_id = await session.scalar(_select_product(user, name))
+        if product_id is None:
+            return None
+        rows = (await session.execute(_select_prices(product_id, start, stop))).all()
+    history = []
+    for datetime_, *prices in rows:
+        price, per_kg = unit_price(*prices)
+        history.append(dict(datetime=datetime_, price=price, per_kg=per_kg))
+    return history
+
+
+def _select_price_changes(user: User, limit: int):
+    change = (ProductPrice.last_price - ProductPrice.first_price) / sqlalchemy.func.abs(
+        ProductPrice.first_price
+    )
+    return (
+        sqlalchemy.select(
+            Product.name,
+            ProductPrice.per_kg,
+            ProductPrice.first_datetime,
+            ProductPrice.first_price,
+            ProductPrice.last_datetime,
+            ProductPrice.last_price,
+            change.label("change"),
+        )
+        .join(Product, Product.id == ProductPrice.product_id)
+        .where(ProductPrice.user_id == user.id)
+        .where(ProductPrice.count > 1)
+        .where(ProductPrice.first_price != 0)
+        .order_by(sqlalchemy.func.abs(change).desc())
+        .limit(limit)
+    )
+
+
+async def get_price_changes_async(user: User, limit: int) -> List[dict]:
+    """Return the products whose unit price changed most since the first bill"""
+    async with AsyncSession(async_read_engine) as session:
+        rows = (await session.execute(_select_price_changes(user, limit))).all()
+    return [row._asdict() for row in rows]
+
+
+def _chart_buckets(
     start: datetime.date,
     stop: datetime.date,
     dt: datetime.timedelta,
 ):
+    """Return the first day of every bucket and the end of the last one"""
     assert stop > start
     assert (start + 1000 * dt) > stop
-    data = []
+    buckets = []
     x = start
     while x <= stop:
-        with sqlalchemy.orm.Session(engine) as session:
-            value = (
-                session.query(sqlalchemy.func.sum(Bill.value))
-                .filter(Bill.datetime >= x)
-                .filter(Bill.datetime < x + dt)
-                .filter(Bill.user_id == user.id)
-                .order_by(Bill.datetime)
-                .scalar()
-            )
-            value = 0 if value is None else value
-            data.append([x, value])
-            session.close()
+        buckets.append(x)
         x += dt
-    return data
+    return buckets, x
+
+
+def _select_daily_totals(user: User, start: datetime.date, end: datetime.date):
+    return (
+        sqlalchemy.select(DailyTotal.day, DailyTotal.value)
+        .where(DailyTotal.user_id == user.id)
+        .where(DailyTotal.day >= start)
+        .where(DailyTotal.day < end)
+    )
+
 
+def _fill_buckets(buckets: List[datetime.date], rows):
+    # All bucket edges fall on day boundaries, so the daily totals can simply
+    # be assigned to their buckets.
+    values = [0] * len(buckets)
+    for day, value in rows:
+        values[bisect.bisect_right(buckets, day) - 1] += value
+    return [[x, value] for x, value in zip(buckets, values)]
 
-def retrieve_product_sum(
+
+async def retrieve_sum_expenses_async(
     user: User,
     start: datetime.date,
     stop: datetime.date,
+    dt: datetime.timedelta,
 ):
-    data = []
-    with sqlalchemy.orm.Session(engine) as session:
-        data = (
-            session.query(
-                Expense.name, sqlalchemy.func.sum(Expense.value).label("total_value")
-            )
-            .filter(Expense.datetime >= start)
-            .filter(Expense.datetime <= stop)
-            .filter(Expense.user_id == user.id)
-            .group_by(Expense.name)
-            .order_by(sqlalchemy.func.sum(Expense.value).desc())
-            .all()
+    buckets, end = _chart_buckets(start, stop, dt)
+    async with AsyncSession(async_read_engine) as session:
+        rows = (await session.execute(_select_daily_totals(user, start, end))).all()
+    return _fill_buckets(buckets, rows)
+
+
+def _select_product_sum(user: User, start: datetime.date, stop: datetime.date):
+    total_value = sqlalchemy.func.sum(DailyProductTotal.value)
+    # Comparing the expense timestamps against the stop date never included
+    # the stop day itself, so neither does the rollup query.
+    # Grouping on the product ids first, the names are only joined to the
+    # totals per product.
+    totals = (
+        sqlalchemy.select(
+            DailyProductTotal.product_id, total_value.label("total_value")
         )
+        .where(DailyProductTotal.user_id == user.id)
+        .where(DailyProductTotal.day >= start)
+        .where(DailyProductTotal.day < stop)
+        .group_by(DailyProductTotal.product_id)
+        .subquery()
+    )
+    return (
+        sqlalchemy.select(Product.name, totals.c.total_value)
+        .join(totals, Product.id == totals.c.product_id)
+        .order_by(totals.c.total_value.desc())
+    )
+
+
+async def retrieve_product_sum_async(
+    user: User,
+    start: datetime.date,
+    stop: datetime.date,
+):
+    async with AsyncSession(async_read_engine) as session:
+        data = (await session.execute(_select_product_sum(user, start, stop))).all()
     return [list(x) for x in data]
+
+
+def jsonify_job(job: Job):
+    return {
+        column.key: getattr(job, column.key)
+        for column in job.__table__.columns
+        if column.key != "ebon"
+    }
+
+
+async def add_job_async(
+    user: User, file_name: str | None, file_hash: str, ebon: bytes
+) -> Job:
+    now = datetime.datetime.now()
+    job = Job(
+        user_id=user.id,
+        file_name=file_name,
+        file_hash=file_hash,
+        ebon=ebon,
+        created=now,
+        updated=now,
+    )
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        session.add(job)
+        await session.commit()
+    return job
+
+
+async def claim_job_async(
+    stale_before: datetime.datetime,
+) -> tuple[int, int, str, bytes] | None:
+    """Mark the oldest queued job as running
+
+    Running jobs not updated since stale_before count as queued, the worker
+    running them is gone. Returns the id, user id, file hash and eBon of the
+    job. The single UPDATE keeps two workers from claiming the same job.
+    """
+    claimable = sqlalchemy.or_(
+        Job.status == "queued",
+        sqlalchemy.and_(Job.status == "running", Job.updated < stale_before),
+    )
+    oldest = (
+        sqlalchemy.select(Job.id)
+        .where(claimable)
+        .order_by(Job.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    query = (
+        sqlalchemy.update(Job)
+        .where(Job.id == oldest)
+        .where(claimable)
+        .values(status="running", updated=datetime.datetime.now())
+        .returning(Job.id, Job.user_id, Job.file_hash, Job.ebon)
+    )
+    async with AsyncSession(async_engine) as session:
+        job = (await session.execute(query)).one_or_none()
+        await session.commit()
+    return None if job is None else tuple(job)
+
+
+async def touch_job_async(job_id: int):
+    """Show that the worker running a job is alive"""
+    query = (
+        sqlalchemy.update(Job)
+        .where(Job.id == job_id, Job.status == "running")
+        .values(updated=datetime.datetime.now())
+    )
+    async with AsyncSession(async_engine) as session:
+        await session.execute(query)
+        await session.commit()
+
+
+async def finish_job_async(
+    job_id: int, status: str, bill_id: int = None, error: str = None
+):
+    """Record the outcome of a job; queued puts it back into the queue"""
+    values = dict(status=status, updated=datetime.datetime.now())
+    if status != "queued":
+        values.update(bill_id=bill_id, error=error, ebon=None)
+    query = sqlalchemy.update(Job).where(Job.id == job_id).values(**values)
+    async with AsyncSession(async_engine) as session:
+        await session.execute(query)
+        await session.commit()
+
+
+async def get_job_async(user: User, job_id: int) -> Job | None:
+    query = sqlalchemy.select(Job).where(Job.id == job_id, Job.user_id == user.id)
+    async with AsyncSession(async_read_engine) as session:
+        return (await session.scalars(query)).one_or_none()
+
+
+async def get_jobs_async(user: User, limit: int) -> List[Job]:
+    query = (
+        sqlalchemy.select(Job)
+        .where(Job.user_id == user.id)
+        .order_by(Job.id.desc())
+        .limit(limit)
+    )
+    async with AsyncSession(async_read_engine) as session:
+        return (await session.scalars(query)).all()
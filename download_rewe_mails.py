@@ -1,14 +1,20 @@
 import argparse
+import collections
+import concurrent.futures
 import email
 import email.message
+import email.parser
 import email.policy
 import hashlib
+import json
 import pathlib
 import subprocess
 import sys
+import tempfile
 
 DATA_DIR = (pathlib.Path(__file__).parent / "data").resolve()
 EBON_DIR = DATA_DIR / "ebons"
+MANIFEST_PATH = DATA_DIR / "mail_manifest.json"
 
 
 def call_getmail() -> None:
@@ -17,12 +23,8 @@ def call_getmail() -> None:
 
 
 def __read_mail_file(path: pathlib.Path) -> email.message.Message:
-    with open(path, "r") as file:
-        email_content = file.read()
-    message = email.message_from_string(
-        email_content,
-        policy=email.policy.default,
-    )
+    with open(path, "rb") as file:
+        message = email.parser.BytesParser(policy=email.policy.default).parse(file)
     return message
 
 
@@ -38,26 +40,99 @@ def __extract_pdf_attachment(message) -> (str, bytes):
     raise ValueError("No attachment found.")
 
 
-def extract_attachments(mail_dir: pathlib.Path) -> None:
-    skipped = 0
-    for file_path in (mail_dir / "new").glob("*.L"):
-        message = __read_mail_file(file_path)
-        try:
-            name, attachment = __extract_pdf_attachment(message)
-        except ValueError:
-            continue
-        if name != "REWE-eBon.pdf":
-            print(f"Skipping attachment with name {name}")
-            continue
-        hash_ = hashlib.sha256(attachment).hexdigest()
-        ebon_file_path = EBON_DIR / f"REWE-eBon-{hash_}.pdf"
-        if ebon_file_path.exists():
-            skipped += 1
-            continue
-        with open(ebon_file_path, "wb") as f:
-            f.write(attachment)
-            print(f"Attachment written to {ebon_file_path}")
-    print(f"Skipped {skipped} eBons (already parsed)")
+def __file_key(path: pathlib.Path) -> list:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_manifest() -> dict:
+    """Return the processed mail files by name, with their size and mtime"""
+    if not MANIFEST_PATH.exists():
+        return {}
+    with open(MANIFEST_PATH, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: dict):
+    tmp_path = MANIFEST_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file)
+    tmp_path.replace(MANIFEST_PATH)
+
+
+def extract_attachment(file_path: pathlib.Path) -> tuple[str, pathlib.Path | None]:
+    """Write the eBon attached to a mail
+
+    Returns what happened to the mail and the path of the eBon.
+    """
+    message = __read_mail_file(file_path)
+    try:
+        name, attachment = __extract_pdf_attachment(message)
+    except ValueError:
+        return "no_attachment", None
+    if name != "REWE-eBon.pdf":
+        print(f"Skipping attachment with name {name}")
+        return "other_attachment", None
+    hash_ = hashlib.sha256(attachment).hexdigest()
+    ebon_file_path = EBON_DIR / f"REWE-eBon-{hash_}.pdf"
+    if ebon_file_path.exists():
+        return "skipped", ebon_file_path
+    # Written under a temporary name first, so the uploader never sees a
+    # partial eBon. The name is unique, mails with the same attachment may be
+    # extracted at the same time.
+    with tempfile.NamedTemporaryFile(
+        dir=EBON_DIR, prefix=ebon_file_path.stem + "-", suffix=".tmp", delete=False
+    ) as f:
+        f.write(attachment)
+    pathlib.Path(f.name).replace(ebon_file_path)
+    print(f"Attachment written to {ebon_file_path}")
+    return "written", ebon_file_path
+
+
+def extract_mail_files(
+    file_paths: list[pathlib.Path], workers: int = 4
+) -> list[pathlib.Path]:
+    """Extract the eBons of the mails that changed since they were processed
+
+    Returns the paths of the eBons attached to these mails, including the
+    ones that were written before.
+    """
+    manifest = load_manifest()
+    new_files = []
+    for file_path in file_paths:
+        key = __file_key(file_path)
+        if manifest.get(file_path.name) != key:
+            new_files.append((file_path, key))
+
+    stats = collections.Counter()
+    ebons = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(extract_attachment, file_path): (file_path, key)
+            for file_path, key in new_files
+        }
+        for future in concurrent.futures.as_completed(futures):
+            file_path, key = futures[future]
+            try:
+                result, ebon_file_path = future.result()
+            except Exception as e:
+                # The mail is not added to the manifest, so it is retried.
+                print(f"Failed to read {file_path}: {e!r}")
+                continue
+            stats[result] += 1
+            manifest[file_path.name] = key
+            if ebon_file_path is not None:
+                ebons.append(ebon_file_path)
+    save_manifest(manifest)
+    print(
+        f"Read {len(new_files)} new mails, wrote {stats['written']} eBons, "
+        f"skipped {stats['skipped']} eBons (already parsed)"
+    )
+    return ebons
+
+
+def extract_attachments(mail_dir: pathlib.Path, workers: int = 4) -> list[pathlib.Path]:
+    return extract_mail_files(list((mail_dir / "new").glob("*.L")), workers)
 
 
 def parse_args() -> argparse.Namespace:
@@ -67,6 +142,13 @@ def parse_args() -> argparse.Namespace:
         type=pathlib.Path,
         help="Directory to mail folder from getmail",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of mails parsed concurrently",
+    )
     args = parser.parse_args()
     if not (args.mail_dir / "new").exists():
         print(f"{args.mail_dir} seems to be an incorrect mail directory")
@@ -77,7 +159,7 @@ def parse_args() -> argparse.Namespace:
 def main():
     args = parse_args()
     call_getmail()
-    extract_attachments(args.mail_dir)
+    extract_attachments(args.mail_dir, args.workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+"""Process pool for the CPU heavy eBon extraction
+
+pdfminer blocks the interpreter for the whole extraction, so the PDFs are
+parsed in worker processes. Only the database write stays in the server
+process. The number of queued and running jobs is bounded; once the pool is
+saturated, new uploads are rejected with 503 and a Retry-After header.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+import db
+import metrics
+import rewe_process
+
+load_dotenv()
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+PDF_QUEUE_DEPTH = int(os.getenv("PDF_QUEUE_DEPTH", 4 * PDF_WORKERS))
+PDF_TIMEOUT = float(os.getenv("PDF_TIMEOUT", 30))
+PDF_RETRY_AFTER = int(os.getenv("PDF_RETRY_AFTER", 5))
+
+_executor: concurrent.futures.ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+# Released by the executor once a job has really finished, not when the
+# request waiting for it gives up.
+_slots = threading.BoundedSemaphore(PDF_QUEUE_DEPTH)
+
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PDF_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+def _reset_executor(broken: concurrent.futures.ProcessPoolExecutor):
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _recycle_executor(executor: concurrent.futures.ProcessPoolExecutor):
+    """Replace the pool and kill its workers, e.g. one stuck in pdfminer
+
+    Shutting down does not stop running jobs, so their slots would stay taken.
+    The jobs of the killed workers fail with BrokenProcessPool, which releases
+    their slots.
+    """
+    processes = list((executor._processes or {}).values())
+    _reset_executor(executor)
+    for process in processes:
+        process.terminate()
+
+
+def _extract(ebon: bytes) -> (((list[db.Expense], float), dict[str, float]), float):
+    started = time.time()
+    return rewe_process.extract_rewe_ebon(ebon), started
+
+
+def _release_slot(_future: concurrent.futures.Future):
+    _slots.release()
+
+
+def _service_unavailable() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Too many eBons are being processed, try again later.",
+        headers={"Retry-After": str(PDF_RETRY_AFTER)},
+    )
+
+
+async def extract(ebon: bytes) -> (list[db.Expense], float):
+    """Run rewe_process.extract_rewe_ebon in the process pool"""
+    if not _slots.acquire(blocking=False):
+        raise _service_unavailable()
+    executor = _get_executor()
+    submitted = time.time()
+    try:
+        future = executor.submit(_extract, ebon)
+    except BrokenProcessPool:
+        _slots.release()
+        _reset_executor(executor)
+        raise _service_unavailable()
+    future.add_done_callback(_release_slot)
+    try:
+        # Cancelling the wrapper also cancels the job if it has not started.
+        (result, stages), started = await asyncio.wait_for(
+            asyncio.wrap_future(future), PDF_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        _recycle_executor(executor)
+        raise HTTPException(
+            status_code=504, detail="Processing the eBon took too long."
+        )
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        raise _service_unavailable()
+    metrics.QUEUE_WAIT_SECONDS.observe(max(0.0, started - submitted), "pdf")
+    for stage, seconds in stages.items():
+        metrics.observe_stage(stage, seconds)
+    return result
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
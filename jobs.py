@@ -0,0 +1,112 @@
+"""Background ingestion of uploaded eBons
+
+Uploads with background=true are stored in the jobs table and answered at
+once. A few worker tasks in the API process take the jobs from the table,
+parse the eBons in ebon_pool and store the bills. The queue lives in the
+database, so jobs survive a restart. A worker updates its running job every
+JOB_HEARTBEAT_INTERVAL; a running job without update for JOB_STALE_AFTER,
+e.g. of a crashed or restarted API process, is claimed again. Jobs that other
+API processes are still running are left alone.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import os
+import traceback
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+import chart_cache
+import db
+import ebon_pool
+import rewe_process
+
+load_dotenv()
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", ebon_pool.PDF_WORKERS))
+# Jobs added by another process are picked up after at most this time.
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", 10))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", 6 * JOB_HEARTBEAT_INTERVAL))
+
+_wakeup = asyncio.Event()
+_workers: list[asyncio.Task] = []
+
+
+def notify():
+    """Wake the workers up after a job was added"""
+    _wakeup.set()
+
+
+async def _process(job_id: int, user_id: int, file_hash: str, ebon: bytes):
+    try:
+        expenses, total = await ebon_pool.extract(ebon)
+    except HTTPException as e:
+        if e.status_code == 503:
+            # The pool is busy with synchronous uploads, try again later.
+            await db.finish_job_async(job_id, "queued")
+            await asyncio.sleep(ebon_pool.PDF_RETRY_AFTER)
+            return
+        await db.finish_job_async(job_id, "failed", error=e.detail)
+        return
+    except Exception:
+        await db.finish_job_async(job_id, "failed", error="Invalid eBon.")
+        return
+    [(bill_id, _)] = await run_in_threadpool(
+        rewe_process.store_rewe_ebons, [(expenses, total, file_hash)], user_id
+    )
+    chart_cache.cache.invalidate(user_id)
+    await db.finish_job_async(job_id, "done", bill_id=bill_id)
+
+
+async def _heartbeat(job_id: int):
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        with contextlib.suppress(Exception):
+            await db.touch_job_async(job_id)
+
+
+async def _work():
+    while True:
+        job = None
+        try:
+            # Cleared before looking for a job, so a job added meanwhile is
+            # not missed.
+            _wakeup.clear()
+            stale_before = datetime.datetime.now() - datetime.timedelta(
+                seconds=JOB_STALE_AFTER
+            )
+            job = await db.claim_job_async(stale_before)
+            if job is None:
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                heartbeat = asyncio.create_task(_heartbeat(job[0]))
+                try:
+                    await _process(*job)
+                finally:
+                    heartbeat.cancel()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+            if job is not None:
+                with contextlib.suppress(Exception):
+                    await db.finish_job_async(job[0], "failed", error="Internal error.")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+def start():
+    for _ in range(JOB_WORKERS):
+        _workers.append(asyncio.create_task(_work()))
+
+
+async def stop():
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
@@ -0,0 +1,265 @@
+"""Request, query and eBon ingestion metrics in the Prometheus text format
+
+The middleware times every request and collects the queries the request ran
+through a context variable; the engines of db.py report their queries with
+SQLAlchemy events. Stages of the request and of the eBon ingestion, e.g. the
+authentication or the pdfminer extraction, are timed with stage(). All of it
+is kept in histograms, which /metrics renders for Prometheus.
+
+The histograms live in the process, with several server processes each one
+reports its own requests. Requests slower than SLOW_REQUEST_SECONDS are
+printed together with their queries.
+"""
+
+import bisect
+import contextlib
+import contextvars
+import os
+import re
+import threading
+import time
+
+import sqlalchemy
+from dotenv import load_dotenv
+
+load_dotenv()
+# 0 disables the slow request log.
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 0))
+SLOW_QUERY_LENGTH = 200
+TIME_BUCKETS = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+]
+COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500]
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_histograms: list["Histogram"] = []
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: list[float] = TIME_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # The counts per bucket and the sums by label values. The last count
+        # is the one of the +Inf bucket.
+        self._counts: dict[tuple[str, ...], list[int]] = {}
+        self._sums: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        _histograms.append(self)
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(label_values)
+            if counts is None:
+                counts = self._counts[label_values] = [0] * (len(self.buckets) + 1)
+                self._sums[label_values] = 0.0
+            counts[index] += 1
+            self._sums[label_values] += value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            series = {
+                key: (list(counts), self._sums[key])
+                for key, counts in self._counts.items()
+            }
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = [
+                f'{label}="{_escape(value)}"'
+                for label, value in zip(self.labels, label_values)
+            ]
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(
+                    f"{self.name}_bucket{{{','.join(labels + [le])}}} {cumulative}"
+                )
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of the response.",
+    ("method", "route", "status"),
+)
+REQUEST_QUERIES = Histogram(
+    "http_request_queries",
+    "Number of database queries per request.",
+    ("route",),
+    COUNT_BUCKETS,
+)
+REQUEST_QUERY_SECONDS = Histogram(
+    "http_request_query_duration_seconds",
+    "Time per request spent in database queries.",
+    ("route",),
+)
+QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time per database query, within requests or not.",
+)
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds",
+    "Time spent in the stages of requests and of the eBon ingestion.",
+    ("stage",),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "queue_wait_seconds",
+    "Time jobs waited for a worker of a process pool.",
+    ("pool",),
+)
+
+
+class RequestStats:
+    """What a request spent its time on"""
+
+    def __init__(self, keep_queries: bool):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.stages: dict[str, float] = {}
+        self.statements: list[tuple[float, str]] | None = [] if keep_queries else None
+
+
+_request_stats: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def observe_stage(stage_name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage_name)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.stages[stage_name] = stats.stages.get(stage_name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def stage(stage_name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage_name, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["query_start"].pop()
+    QUERY_SECONDS.observe(seconds)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += seconds
+        if stats.statements is not None:
+            stats.statements.append((seconds, statement))
+
+
+def _handle_error(exception_context):
+    # The query failed, after_cursor_execute does not run.
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+
+def instrument_engine(engine: sqlalchemy.Engine):
+    """Time the queries of an engine, for an AsyncEngine pass its sync_engine"""
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", _handle_error)
+
+
+def _print_slow_request(method: str, path: str, status: int, seconds: float, stats):
+    stages = ", ".join(f"{name} {1000 * s:.1f} ms" for name, s in stats.stages.items())
+    print(
+        f"Slow request {method} {path} {status} in {1000 * seconds:.1f} ms, "
+        f"{stats.queries} queries in {1000 * stats.query_seconds:.1f} ms"
+        + (f", {stages}" if stages else "")
+    )
+    for query_seconds, statement in stats.statements:
+        statement = re.sub(r"\s+", " ", statement).strip()
+        if len(statement) > SLOW_QUERY_LENGTH:
+            statement = statement[:SLOW_QUERY_LENGTH] + "..."
+        print(f"  {1000 * query_seconds:8.1f} ms  {statement}")
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing the requests until the last byte is sent
+
+    Unlike a middleware returning when the response starts, the time of
+    streamed responses, e.g. the exports, includes their body.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(keep_queries=SLOW_REQUEST_SECONDS > 0)
+        token = _request_stats.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            _request_stats.reset(token)
+            # The path template of the matched route, so the paths with ids
+            # or names share their series.
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.observe(seconds, scope["method"], route, str(status))
+            REQUEST_QUERIES.observe(stats.queries, route)
+            REQUEST_QUERY_SECONDS.observe(stats.query_seconds, route)
+            if SLOW_REQUEST_SECONDS > 0 and seconds >= SLOW_REQUEST_SECONDS:
+                _print_slow_request(
+                    scope["method"], scope["path"], status, seconds, stats
+                )
+
+
+def render() -> str:
+    lines = []
+    for histogram in _histograms:
+        lines += histogram.render()
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,91 @@
+"""Password hashing and verification off the event loop
+
+A bcrypt hash takes tens to hundreds of milliseconds of CPU and the crypt
+backend of passlib holds the GIL meanwhile, so the API runs it in a small
+process pool. The number of queued and running jobs is capped; beyond that,
+logins are rejected with 503 instead of piling up.
+
+Hashes with another work factor than BCRYPT_ROUNDS are upgraded on the next
+successful login.
+"""
+
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+import metrics
+
+load_dotenv()
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", min(2, os.cpu_count() or 1)))
+PASSWORD_QUEUE_DEPTH = int(os.getenv("PASSWORD_QUEUE_DEPTH", 16 * PASSWORD_WORKERS))
+PASSWORD_RETRY_AFTER = int(os.getenv("PASSWORD_RETRY_AFTER", 1))
+
+context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS)
+_executor: concurrent.futures.ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_DEPTH)
+
+
+def _hash(password: str) -> (str, float):
+    started = time.time()
+    return context.hash(password), started
+
+
+def _verify_and_update(password: str, hash_: str) -> ((bool, str | None), float):
+    started = time.time()
+    return context.verify_and_update(password, hash_), started
+
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PASSWORD_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+async def _run(function, *args):
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Too many logins, try again later.",
+            headers={"Retry-After": str(PASSWORD_RETRY_AFTER)},
+        )
+    submitted = time.time()
+    try:
+        future = _get_executor().submit(function, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    result, started = await asyncio.wrap_future(future)
+    metrics.QUEUE_WAIT_SECONDS.observe(max(0.0, started - submitted), "password")
+    return result
+
+
+async def hash(password: str) -> str:
+    return await _run(_hash, password)
+
+
+async def verify_and_update(password: str, hash_: str) -> (bool, str | None):
+    """Verify a password; also return a new hash if the stored one is outdated"""
+    return await _run(_verify_and_update, password, hash_)
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
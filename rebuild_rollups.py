@@ -0,0 +1,35 @@
+import argparse
+
+import db
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("Rebuild the daily rollup tables")
+    parser.add_argument(
+        "-u",
+        "--user",
+        type=str,
+        default=None,
+        help="Only rebuild the rollups of this user",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    user_id = None
+    if args.user is not None:
+        user = db.find_user(args.user)
+        if user is None:
+            raise SystemExit(f"Unknown user {args.user}")
+        user_id = user.id
+    # create_database fills the rollups of databases that predate them, this
+    # script repairs them, e.g. after bills were changed by hand.
+    db.create_database()
+    db.rebuild_rollups(user_id)
+    print("Rebuilt daily rollups")
+
+
+if __name__ == "__main__":
+    main()
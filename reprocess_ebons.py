@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import multiprocessing
+import os
+import pathlib
+import time
+
+import db
+import rewe_process
+
+DATA_DIR = (pathlib.Path(__file__).parent / "data").resolve()
+EBON_DIR = DATA_DIR / "ebons"
+TEXT_CACHE_DIR = DATA_DIR / "ebon_texts"
+CHUNK_SIZE = 500
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        "Parse the stored eBons again and rewrite their bills"
+    )
+    parser.add_argument(
+        "-u",
+        "--user",
+        type=str,
+        required=True,
+        help="User owning the eBons",
+    )
+    parser.add_argument(
+        "-d",
+        "--ebon-dir",
+        type=pathlib.Path,
+        default=EBON_DIR,
+        help="Directory with the eBon PDFs",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        type=pathlib.Path,
+        default=TEXT_CACHE_DIR,
+        help="Directory caching the text extracted from the PDFs",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes",
+    )
+    args = parser.parse_args()
+    return args
+
+
+def process_ebon(path: pathlib.Path, cache_dir: pathlib.Path):
+    """Parse an eBon in a worker process, returns (path, hash, parsed eBon)"""
+    with open(path, "rb") as fd:
+        ebon = fd.read()
+    file_hash = hashlib.sha256(ebon).hexdigest()
+    try:
+        text = rewe_process.extract_ebon_text(ebon, cache_dir)
+        return path, file_hash, rewe_process.parse_rewe_ebon_text(text)
+    except Exception as e:
+        return path, file_hash, e
+
+
+def write_chunk(user: db.User, parsed: list[tuple[str, list[db.Expense], float]]):
+    """Rewrite the bills of already known eBons and insert the other ones"""
+    known = db.find_bill_ids_by_hashes(user, [file_hash for file_hash, _, _ in parsed])
+    existing = []
+    new = []
+    for file_hash, expenses, total in parsed:
+        if file_hash in known:
+            existing.append((known[file_hash], expenses, total))
+        else:
+            new.append((expenses, total, file_hash))
+    if existing:
+        rewe_process.replace_rewe_ebons(existing, user.id)
+    if new:
+        rewe_process.store_rewe_ebons(new, user.id)
+    return len(existing), len(new)
+
+
+def main():
+    args = parse_args()
+    # The bills are written with the current schema, e.g. the rollup tables.
+    db.create_database()
+    user = db.find_user(args.user)
+    if user is None:
+        raise SystemExit(f"Unknown user {args.user}")
+    args.cache_dir.mkdir(parents=True, exist_ok=True)
+    paths = sorted(args.ebon_dir.glob("REWE-eBon*pdf"))
+
+    start = time.perf_counter()
+    stats = dict(updated=0, created=0, failed=0)
+    parsed = []
+    process = functools.partial(process_ebon, cache_dir=args.cache_dir)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        results = executor.map(process, paths, chunksize=16)
+        for i, (path, file_hash, result) in enumerate(results, start=1):
+            if isinstance(result, Exception):
+                print(f"Failed to parse {path}: {result!r}")
+                stats["failed"] += 1
+            else:
+                expenses, total = result
+                parsed.append((file_hash, expenses, total))
+            if len(parsed) == CHUNK_SIZE or i == len(paths):
+                if parsed:
+                    updated, created = write_chunk(user, parsed)
+                    stats["updated"] += updated
+                    stats["created"] += created
+                    parsed = []
+            if i % 100 == 0 or i == len(paths):
+                elapsed = time.perf_counter() - start
+                print(f"{i}/{len(paths)} eBons, {i / elapsed:.1f} eBons/s")
+
+    db.rebuild_rollups(user.id)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Updated {stats['updated']}, created {stats['created']} and failed to "
+        f"parse {stats['failed']} eBons in {elapsed:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
-import datetime
 import hashlib
 import io
 import math
+import os
+import pathlib
 import re
+import time
 
+import sqlalchemy
 from pdfminer.high_level import extract_text
 from sqlalchemy.orm import Session
 
 import db
+import metrics
 
 PRODUCT_PATTERN = r"^(.+?)\s+(\-?\d+,\d+) \w\s*[\*]*$"
 WEIGHT_PATTERN = r"\s+(\d+,\d+) kg x\s+(\d+,\d+) EUR/kg"
@@ -18,42 +22,66 @@ TIME_PATTERN = r"Uhrzeit:\s+(\d{2}:\d{2}:\d{2}) Uhr"
 DATE_TIME_PATTERN = r"\s*\s+(\d{2}\.\d{2}\.\d{4})\s*(\d{2}:\d{2})"
 TOTAL_PATTERN = r"SUMME\s+EUR\s+(\d+,\d+)"
 
+# The patterns in the order they are tried on every line of an eBon. Each
+# pattern comes with a literal that every matching line contains, so most
+# lines are classified by a few substring checks instead of regex searches.
+LINE_CLASSIFIER = [
+    (kind, literal, re.compile(pattern))
+    for kind, literal, pattern in [
+        ("product", ",", PRODUCT_PATTERN),
+        ("weight", " kg x", WEIGHT_PATTERN),
+        ("weight_butcher", "Handeingabe E-Bon", WEIGHT_BUTCHER_PATTERN),
+        ("amount", " Stk x", AMOUNT_PATTERN),
+        ("date", "Datum:", DATE_PATTERN),
+        ("time", "Uhrzeit:", TIME_PATTERN),
+        ("date_time", ":", DATE_TIME_PATTERN),
+        ("total", "SUMME", TOTAL_PATTERN),
+    ]
+]
+
 
 def __atof(x: str):
     """Convert str to float handling numbers in german locale form"""
     return float(x.replace(",", "."))
 
 
-def __parse_rewe_ebon_text(text: str):
+def __classify_line(line: str) -> (str | None, re.Match | None):
+    """Return the kind of the first pattern matching the line and its match"""
+    for kind, literal, pattern in LINE_CLASSIFIER:
+        if literal in line and (m := pattern.search(line)):
+            return kind, m
+    return None, None
+
+
+def parse_rewe_ebon_text(text: str):
     expense = None
     expenses = []
     for line in text.split("\n"):
+        kind, m = __classify_line(line)
         # Once we match a new product, the previous one can be saved.
-        if m := re.search(PRODUCT_PATTERN, line):
+        if kind == "product":
             if expense is not None:
                 expenses.append(expense)
             expense = db.Expense()
             expense.name = m.group(1)
             expense.value = __atof(m.group(2))
-        elif m := re.search(WEIGHT_PATTERN, line):
+        elif kind == "weight":
             expense.weight = __atof(m.group(1))
             expense.price_per_kg = __atof(m.group(2))
-        elif m := re.search(WEIGHT_BUTCHER_PATTERN, line):
+        elif kind == "weight_butcher":
             expense.weight = __atof(m.group(1))
-        elif m := re.search(AMOUNT_PATTERN, line):
+        elif kind == "amount":
             expense.quantity = int(m.group(1))
             expense.price_per_item = __atof(m.group(2))
-        elif m := re.search(DATE_PATTERN, line):
+        elif kind == "date":
             date = m.group(1)
-        elif m := re.search(TIME_PATTERN, line):
+        elif kind == "time":
             time = m.group(1)
-        elif m := re.search(DATE_TIME_PATTERN, line):
+        elif kind == "date_time":
             date = m.group(1)
             time = m.group(2) + ":00"
-        elif m := re.search(TOTAL_PATTERN, line):
+        elif kind == "total":
             total = __atof(m.group(1))
-        else:
-            pass
     expenses.append(expense)
     dt = db.datetime.datetime.strptime(date + time, r"%d.%m.%Y%H:%M:%S")
     for expense in expenses:
@@ -62,40 +90,202 @@ def __parse_rewe_ebon_text(text: str):
     return expenses, total
 
 
-def parse_rewe_ebon(ebon: bytes, user_id: int) -> int:
+def extract_ebon_text(ebon: bytes, cache_dir: pathlib.Path | None = None) -> str:
+    """Extract the text of an eBon PDF
+
+    With a cache directory, the text is stored there by the SHA-256 of the PDF
+    and later calls for the same PDF skip pdfminer.
+    """
+    if cache_dir is not None:
+        cache_path = cache_dir / f"{hashlib.sha256(ebon).hexdigest()}.txt"
+        if cache_path.exists():
+            return cache_path.read_text()
     with io.BytesIO(ebon) as fd:
         text = extract_text(fd)
-    expenses, total = __parse_rewe_ebon_text(text)
-    bill_datetime = expenses[0].datetime
+    if cache_dir is not None:
+        # Written under a temporary name first, so concurrent readers never
+        # see a partial file.
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(text)
+        tmp_path.replace(cache_path)
+    return text
+
+
+def extract_rewe_ebon(ebon: bytes) -> ((list[db.Expense], float), dict[str, float]):
+    """Extract the text of an eBon PDF and parse it
+
+    This is the CPU heavy part of the eBon processing. It does not touch the
+    database, so it can run in a worker process. The seconds spent in the
+    extract and parse stages are returned as well, for the metrics of the
+    server process.
+    """
+    start = time.perf_counter()
+    text = extract_ebon_text(ebon)
+    extracted = time.perf_counter()
+    result = parse_rewe_ebon_text(text)
+    stages = dict(extract=extracted - start, parse=time.perf_counter() - extracted)
+    return result, stages
+
+
+def _column_values(obj: db.Base) -> dict:
+    """Return the values of all columns but the primary key, for bulk inserts
+
+    Columns not set on the object get their default or None. The dicts of all
+    objects share their keys and, inserted with render_nulls, the None values
+    are sent too; otherwise SQLAlchemy splits the executemany by key set.
+    """
+    values = {}
+    for column in obj.__table__.columns:
+        if column.primary_key:
+            continue
+        if column.key in obj.__dict__:
+            values[column.key] = obj.__dict__[column.key]
+        elif column.default is not None and column.default.is_scalar:
+            values[column.key] = column.default.arg
+        else:
+            values[column.key] = None
+    return values
+
+
+def _set_product_ids(session: Session, expenses: list[db.Expense], user_id: int):
+    product_ids = db.intern_products(session, user_id, {e.name for e in expenses})
+    for expense in expenses:
+        expense.product_id = product_ids[expense.name]
 
-    def find_bill(d: datetime.datetime) -> db.Bill | None:
-        query = session.query(db.Bill).filter(db.Bill.datetime == d)
-        bill = query.first()
-        if bill is not None:
-            print(f"Bill already exists (id={bill.id})")
-            return bill
 
-    # We refresh ORM objects so that autoincremented values are accessible.
+def store_rewe_ebons(
+    ebons: list[tuple[list[db.Expense], float, str]],
+    user_id: int,
+) -> list[tuple[int, bool]]:
+    """Insert parsed eBons (expenses, total, file hash) in a single transaction
+
+    Returns the bill id of every eBon and whether the bill was created. eBons
+    whose bill already exists, or that occur twice in the batch, are skipped.
+    """
     with Session(db.engine) as session:
-        bill = find_bill(bill_datetime)
-        if bill is not None:
-            return bill.id
-        bill = db.Bill(
-            user_id=user_id,
-            datetime=bill_datetime,
-            value=total,
-            file_hash=hashlib.sha256(ebon).hexdigest(),
-        )
+        with metrics.stage("dedupe"):
+            datetimes = [expenses[0].datetime for expenses, _, _ in ebons]
+            hashes = [file_hash for _, _, file_hash in ebons]
+            existing = dict(
+                session.execute(
+                    sqlalchemy.select(db.Bill.datetime, db.Bill.id)
+                    .where(db.Bill.user_id == user_id)
+                    .where(db.Bill.datetime.in_(datetimes))
+                ).all()
+            )
+            existing_hashes = dict(
+                session.execute(
+                    sqlalchemy.select(db.Bill.file_hash, db.Bill.id)
+                    .where(db.Bill.user_id == user_id)
+                    .where(db.Bill.file_hash.in_(hashes))
+                ).all()
+            )
+
+            # Duplicates within the batch refer to the first new bill with the
+            # same datetime or file hash.
+            bills = []
+            created = []
+            created_index = {}
+            for expenses, total, file_hash in ebons:
+                bill_datetime = expenses[0].datetime
+                bill_id = existing_hashes.get(file_hash, existing.get(bill_datetime))
+                if bill_id is not None:
+                    print(f"Bill already exists (id={bill_id})")
+                    bills.append((bill_id, False))
+                    continue
+                index = created_index.get(file_hash, created_index.get(bill_datetime))
+                if index is not None:
+                    bills.append((created[index][0], False))
+                    continue
+                bill = db.Bill(
+                    user_id=user_id,
+                    datetime=bill_datetime,
+                    value=total,
+                    file_hash=file_hash,
+                )
+                created_index[file_hash] = created_index[bill_datetime] = len(created)
+                created.append((bill, expenses))
+                bills.append((bill, True))
+
+        with metrics.stage("insert"):
+            if created:
+                # An ordered RETURNING would insert the bills one by one, the
+                # ids are looked up by the file hashes, unique within a user.
+                session.execute(
+                    sqlalchemy.insert(db.Bill),
+                    [_column_values(bill) for bill, _ in created],
+                    execution_options=dict(render_nulls=True),
+                )
+                new_hashes = [bill.file_hash for bill, _ in created]
+                query = sqlalchemy.select(db.Bill.file_hash, db.Bill.id).where(
+                    db.Bill.user_id == user_id
+                )
+                bill_ids = {}
+                for i in range(0, len(new_hashes), db.HASH_CHUNK_SIZE):
+                    chunk = new_hashes[i : i + db.HASH_CHUNK_SIZE]
+                    query_ = query.where(db.Bill.file_hash.in_(chunk))
+                    bill_ids.update(session.execute(query_).all())
+                all_expenses = []
+                for bill, expenses in created:
+                    bill.id = bill_id = bill_ids[bill.file_hash]
+                    for expense in expenses:
+                        expense.user_id = user_id
+                        expense.bill_id = bill_id
+                    all_expenses.extend(expenses)
+                _set_product_ids(session, all_expenses, user_id)
+                session.execute(
+                    sqlalchemy.insert(db.Expense),
+                    [_column_values(expense) for expense in all_expenses],
+                    execution_options=dict(render_nulls=True),
+                )
+                db.add_to_rollups(session, [bill for bill, _ in created], all_expenses)
+            session.commit()
+
+    return [
+        (bill if isinstance(bill, int) else bill.id, is_new) for bill, is_new in bills
+    ]
 
-        session.add(bill)
-        session.flush()
-        session.refresh(bill)
-        bill_id = bill.id
 
-        for expense in expenses:
-            expense.user_id = user_id
-            expense.bill_id = bill_id
-            session.add(expense)
+def replace_rewe_ebons(
+    ebons: list[tuple[int, list[db.Expense], float]],
+    user_id: int,
+):
+    """Overwrite existing bills (bill id, expenses, total) in a single transaction
+
+    The rollups are not updated, rebuild them afterwards.
+    """
+    bill_ids = [bill_id for bill_id, _, _ in ebons]
+    with Session(db.engine) as session:
+        session.execute(
+            sqlalchemy.update(db.Bill),
+            [
+                dict(id=bill_id, datetime=expenses[0].datetime, value=total)
+                for bill_id, expenses, total in ebons
+            ],
+        )
+        session.execute(
+            sqlalchemy.delete(db.Expense).where(db.Expense.bill_id.in_(bill_ids))
+        )
+        all_expenses = []
+        for bill_id, expenses, _ in ebons:
+            for expense in expenses:
+                expense.user_id = user_id
+                expense.bill_id = bill_id
+            all_expenses.extend(expenses)
+        _set_product_ids(session, all_expenses, user_id)
+        session.execute(
+            sqlalchemy.insert(db.Expense),
+            [_column_values(expense) for expense in all_expenses],
+            execution_options=dict(render_nulls=True),
+        )
         session.commit()
 
+
+def store_rewe_ebon(
+    expenses: list[db.Expense],
+    total: float,
+    file_hash: str,
+    user_id: int,
+) -> int:
+    ((bill_id, _),) = store_rewe_ebons([(expenses, total, file_hash)], user_id)
     return bill_id
@@ -1,10 +1,21 @@
+import asyncio
+import concurrent.futures
+import csv
 import functools
+import hashlib
+import http.client
+import io
+import json
 import pathlib
+import time
+import urllib.parse
 
 import pytest
 import requests
 
+import api
 import db
+import rewe_process
 
 TEST_USER_DATA = {"username": "test", "password": "123"}
 PORT = 80
@@ -46,6 +57,19 @@ def test_register():
     assert response.status_code == 201
 
 
+def test_register_concurrently():
+    prepare_db(register=False)
+    user_data = {"username": "concurrent", "password": "123"}
+    url = f"{ROOT}/api/register"
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        responses = list(
+            executor.map(lambda _: requests.post(url, json=user_data), range(4))
+        )
+    assert sorted(r.status_code for r in responses) == [201, 409, 409, 409]
+    response = requests.post(f"{ROOT}/api/login", json=user_data)
+    assert response.status_code == 200
+
+
 def test_login():
     prepare_db()
     response = post(f"{ROOT}/api/login", json=TEST_USER_DATA)
@@ -66,6 +90,63 @@ def test_upload_pdf():
             assert r.status_code == 200
 
 
+def test_upload_pdf_batch():
+    prepare_db()
+    url = f"{ROOT}/api/pdfs/batch"
+    paths = list(pathlib.Path("data/ebons/").iterdir())
+    files = [("files", (path.name, path.read_bytes())) for path in paths]
+    r = post(url, files=files)
+    assert r.status_code == 200
+    assert [x["status"] for x in r.json()] == ["created"] * len(paths)
+
+    r = post(url, files=files)
+    assert r.status_code == 200
+    assert [x["status"] for x in r.json()] == ["duplicate"] * len(paths)
+
+
+def test_upload_pdf_background():
+    prepare_db()
+    paths = sorted(pathlib.Path("data/ebons/").iterdir())[:3]
+    job_ids = []
+    for path in paths:
+        with open(path, "rb") as fd:
+            r = post(f"{ROOT}/api/pdfs?background=true", files={"file": fd})
+        assert r.status_code == 202
+        assert r.json()["status"] == "queued"
+        job_ids.append(r.json()["id"])
+
+    for job_id in job_ids:
+        for _ in range(100):
+            job = get(f"{ROOT}/api/jobs/{job_id}").json()
+            if job["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.1)
+        assert job["status"] == "done"
+        assert job["bill_id"] is not None
+
+    r = get(f"{ROOT}/api/jobs")
+    assert r.status_code == 200
+    assert [job["id"] for job in r.json()] == job_ids[::-1]
+    assert get(f"{ROOT}/api/jobs/0").status_code == 404
+
+
+def test_missing_hashes():
+    prepare_db()
+    path = next(pathlib.Path("data/ebons/").iterdir())
+    with open(path, "rb") as fd:
+        ebon = fd.read()
+    hash_ = hashlib.sha256(ebon).hexdigest()
+    url = f"{ROOT}/api/bills/hashes/missing"
+    response = post(url, json=[hash_, "0" * 64])
+    assert response.status_code == 200
+    assert response.json() == [hash_, "0" * 64]
+
+    post(f"{ROOT}/api/pdfs", files={"file": ebon})
+    response = post(url, json=[hash_, "0" * 64])
+    assert response.status_code == 200
+    assert response.json() == ["0" * 64]
+
+
 def test_upload_image():
     return
     fpath = pathlib.Path(
@@ -86,6 +167,117 @@ def test_bills():
     assert response.status_code == 200
 
 
+def test_bills_pagination():
+    prepare_db()
+    test_upload_pdf()
+    bills = []
+    url = f"{ROOT}/api/bills?limit=7"
+    while True:
+        response = get(url)
+        assert response.status_code == 200
+        bills += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        url = f"{ROOT}/api/bills?limit=7&cursor={cursor}"
+    n_ebons = len(list(pathlib.Path("data/ebons/").iterdir()))
+    assert len({bill["id"] for bill in bills}) == len(bills) == n_ebons
+    datetimes = [bill["datetime"] for bill in bills]
+    assert datetimes == sorted(datetimes, reverse=True)
+    assert all(bill["expenses"] for bill in bills)
+
+
+def test_export():
+    prepare_db()
+    test_upload_pdf()
+    bills = get(f"{ROOT}/api/bills?limit=1000").json()
+    expenses = [expense for bill in bills for expense in bill["expenses"]]
+
+    response = get(f"{ROOT}/api/expenses/export")
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(row["id"] for row in rows) == sorted(e["id"] for e in expenses)
+
+    response = get(f"{ROOT}/api/bills/export?format=csv")
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert sorted(int(row["id"]) for row in rows) == sorted(b["id"] for b in bills)
+
+    day = min(bill["datetime"] for bill in bills)[:10]
+    response = get(f"{ROOT}/api/bills/export?start={day}&stop={day}")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows
+    assert all(row["datetime"].startswith(day) for row in rows)
+
+
+def test_search_expenses():
+    prepare_db()
+    test_upload_pdf()
+    bills = get(f"{ROOT}/api/bills?limit=1000").json()
+    names = [expense["name"] for bill in bills for expense in bill["expenses"]]
+    text = names[0][:4]
+
+    found = []
+    url = f"{ROOT}/api/expenses/search?q={text}&limit=5"
+    while True:
+        response = get(url)
+        assert response.status_code == 200
+        found += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        url = f"{ROOT}/api/expenses/search?q={text}&limit=5&cursor={cursor}"
+    expected = [name for name in names if text.lower() in name.lower()]
+    assert sorted(expense["name"] for expense in found) == sorted(expected)
+    assert get(f"{ROOT}/api/expenses/search?q=").status_code == 422
+
+
+def test_product_prices():
+    prepare_db()
+    test_upload_pdf()
+    bills = get(f"{ROOT}/api/bills?limit=1000").json()
+    names = [expense["name"] for bill in bills for expense in bill["expenses"]]
+    name = max(set(names), key=names.count)
+
+    response = get(f"{ROOT}/api/products/{urllib.parse.quote(name, safe='')}/prices")
+    assert response.status_code == 200
+    assert len(response.json()["prices"]) == names.count(name)
+    assert get(f"{ROOT}/api/products/UNKNOWN/prices").status_code == 404
+
+    response = get(f"{ROOT}/api/products/price-changes?limit=5")
+    assert response.status_code == 200
+    assert len(response.json()) <= 5
+
+
+def test_upload_too_large():
+    prepare_db()
+    # Rejected by the announced size, before the body is sent.
+    connection = http.client.HTTPConnection("localhost", PORT)
+    headers = dict(get_jwt_token(), **{"Content-Length": str(100 * 1024 * 1024)})
+    headers["Content-Type"] = "multipart/form-data; boundary=x"
+    connection.request("POST", "/api/pdfs", headers=headers)
+    response = connection.getresponse()
+    assert response.status == 413
+    assert json.loads(response.read())["detail"] == "The file is too large."
+    connection.close()
+
+
+def test_upload_invalid_content_length():
+    # uvicorn rejects it itself, other servers may pass it on to the app.
+    messages = []
+
+    async def app(scope, receive, send):
+        raise AssertionError("The request reached the app")
+
+    async def send(message):
+        messages.append(message)
+
+    headers = [(b"content-length", b"abc")]
+    scope = {"type": "http", "method": "POST", "path": "/api/pdfs", "headers": headers}
+    asyncio.run(api.UploadSizeMiddleware(app)(scope, None, send))
+    assert messages[0]["status"] == 400
+
+
 def test_charts_daily():
     prepare_db()
     response = get(f"{ROOT}/api/charts/daily")
@@ -102,7 +294,79 @@ def test_charts_monthly():
     assert response.status_code == 200
 
 
+def test_charts_etag():
+    prepare_db()
+    paths = list(pathlib.Path("data/ebons/").iterdir())
+    with open(paths[0], "rb") as fd:
+        response = post(f"{ROOT}/api/pdfs", files={"file": fd})
+    year = response.json()["datetime"][:4]
+    url = f"{ROOT}/api/charts/monthly?year={year}"
+    response = get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    headers = dict(get_jwt_token(), **{"If-None-Match": etag})
+    response = requests.get(url, headers=headers)
+    assert response.status_code == 304
+
+    # New bills invalidate the cached charts.
+    files = [("files", (path.name, path.read_bytes())) for path in paths[1:]]
+    post(f"{ROOT}/api/pdfs/batch", files=files)
+    response = get(url)
+    bills = get(f"{ROOT}/api/bills?limit=1000").json()
+    expected = sum(b["value"] for b in bills if b["datetime"].startswith(year))
+    actual = sum(value for _, value in response.json()["time_data"])
+    assert abs(expected - actual) < 1e-6
+
+
+def test_charts_bills_of_other_processes():
+    prepare_db()
+    paths = sorted(pathlib.Path("data/ebons/").iterdir())
+    response = post(f"{ROOT}/api/pdfs", files={"file": paths[0].read_bytes()})
+    user_id = response.json()["user_id"]
+    ebon = paths[1].read_bytes()
+    (expenses, total), _ = rewe_process.extract_rewe_ebon(ebon)
+    url = f"{ROOT}/api/charts/monthly?year={expenses[0].datetime.year}"
+    before = sum(value for _, value in get(url).json()["time_data"])
+
+    # Stored by this process like the command line scripts do, the cache of
+    # the API is not invalidated.
+    file_hash = hashlib.sha256(ebon).hexdigest()
+    rewe_process.store_rewe_ebons([(expenses, total, file_hash)], user_id)
+    after = sum(value for _, value in get(url).json()["time_data"])
+    assert abs(after - before - total) < 1e-6
+
+
+def test_charts_columnar():
+    prepare_db()
+    test_upload_pdf()
+    for chart in ("daily", "monthly", "yearly"):
+        pairs = get(f"{ROOT}/api/charts/{chart}").json()
+        response = get(f"{ROOT}/api/charts/{chart}?columnar=true")
+        assert response.status_code == 200
+        columns = response.json()
+        assert list(zip(columns["dates"], columns["values"])) == [
+            tuple(x) for x in pairs["time_data"]
+        ]
+        assert list(zip(columns["product_names"], columns["product_totals"])) == [
+            tuple(x) for x in pairs["product_data"]
+        ]
+
+
 def test_charts_yearly():
     prepare_db()
     response = get(f"{ROOT}/api/charts/yearly")
     assert response.status_code == 200
+
+
+def test_metrics():
+    prepare_db()
+    get(f"{ROOT}/api/charts/monthly")
+    response = requests.get(f"{ROOT}/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    route = 'route="/api/charts/monthly"'
+    lines = response.text.splitlines()
+    assert any(line.startswith("http_request_queries_count{" + route) for line in lines)
+    assert any(
+        line.startswith('stage_duration_seconds_count{stage="auth"') for line in lines
+    )
@@ -0,0 +1,459 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+
+import pytest
+import sqlalchemy
+import sqlalchemy.ext.asyncio
+
+import db
+import rewe_process
+from benchmarks import dataset
+from benchmarks.ebon_text import BUTCHER_PRODUCTS, WEIGHED_PRODUCTS, generate_corpus
+
+USER = db.User(id=1, name="test", password="")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = db.create_engine(f"sqlite:///{tmp_path / 'expenses.db'}")
+    db.create_database(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def database(engine, monkeypatch):
+    # The module level engines are replaced by the temporary database.
+    monkeypatch.setattr(db, "engine", engine)
+    monkeypatch.setattr(db, "read_engine", engine)
+    # Every test runs its coroutines with asyncio.run, i.e. in new event
+    # loops, so the async connections are not pooled.
+    url = engine.url.set(drivername="sqlite+aiosqlite")
+    async_engine = sqlalchemy.ext.asyncio.create_async_engine(
+        url, poolclass=sqlalchemy.pool.NullPool
+    )
+    monkeypatch.setattr(db, "async_read_engine", async_engine)
+    monkeypatch.setattr(db, "_product_ids", {})
+    with sqlalchemy.orm.Session(engine) as session:
+        session.add(db.User(id=USER.id, name=USER.name, password=""))
+        session.commit()
+    return engine
+
+
+def query_plan(engine: sqlalchemy.Engine, query) -> str:
+    compiled = query.compile(
+        dialect=engine.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    params = compiled.construct_params()
+    values = tuple(params[name] for name in compiled.positiontup)
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", values)
+        return "\n".join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (db._select_user_by_name("test"), "ix_users_name"),
+        (db._select_bill_rows(USER, 100), "ix_bills_user_id_datetime"),
+        (
+            db._select_bill_rows(USER, 100, (datetime.datetime(2024, 1, 1), 10)),
+            "ix_bills_user_id_datetime",
+        ),
+        (db._select_bill_ids_by_hashes(USER, ["0" * 64]), "ix_bills_user_id_file_hash"),
+        (db._select_expense_rows([1, 2, 3]), "ix_expenses_bill_id"),
+        (db._select_export(db.Bill, USER), "ix_bills_user_id_datetime"),
+        (
+            db._select_export(db.Expense, USER, datetime.date(2024, 1, 1)),
+            "ix_expenses_user_id_datetime_name",
+        ),
+        (
+            db._select_daily_totals(
+                USER, datetime.date(2024, 1, 1), datetime.date(2025, 1, 1)
+            ),
+            "sqlite_autoindex_daily_totals_1",
+        ),
+        (
+            db._select_product_sum(
+                USER, datetime.date(2024, 1, 1), datetime.date(2025, 1, 1)
+            ),
+            "sqlite_autoindex_daily_product_totals_1",
+        ),
+        (db._select_prices(1), "COVERING INDEX ix_expenses_product_id_datetime_prices"),
+        (db._select_price_changes(USER, 20), "ix_product_prices_user_id"),
+    ],
+)
+def test_query_uses_index(engine, query, index):
+    plan = query_plan(engine, query)
+    assert index in plan
+    # Only the materialized subqueries may be scanned, not the tables.
+    scans = {line.split()[1] for line in plan.splitlines() if line.startswith("SCAN")}
+    assert not scans & set(db.Base.metadata.tables), plan
+
+
+@pytest.mark.parametrize("url", ["sqlite://", "sqlite:///:memory:"])
+def test_memory_database(url):
+    # Memory databases use a pool without the size options.
+    engine = db.create_engine(url)
+    db.create_database(engine)
+    with engine.connect() as connection:
+        assert connection.scalar(sqlalchemy.select(db.SchemaVersion.version))
+    engine.dispose()
+
+    async def select_one():
+        async_engine = db.create_async_engine(url, readonly=True)
+        async with async_engine.connect() as connection:
+            result = await connection.scalar(sqlalchemy.select(1))
+        await async_engine.dispose()
+        return result
+
+    assert asyncio.run(select_one()) == 1
+
+
+def test_migrate_existing_database(engine):
+    # A database from before the migrations: no indexes, no version.
+    with engine.begin() as connection:
+        for table in db.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(connection)
+        connection.execute(sqlalchemy.delete(db.SchemaVersion))
+
+    assert db.migrate(engine) == len(db.MIGRATIONS)
+    inspector = sqlalchemy.inspect(engine)
+    indexes = {index["name"] for index in inspector.get_indexes("expenses")}
+    assert {"ix_expenses_bill_id", "ix_expenses_user_id_datetime_name"} <= indexes
+    with engine.connect() as connection:
+        version = connection.scalar(sqlalchemy.select(db.SchemaVersion.version))
+    assert version == len(db.MIGRATIONS)
+
+
+def test_migrate_fills_rollups(database):
+    ebons = []
+    for i, text in enumerate(generate_corpus(20)):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    rewe_process.store_rewe_ebons(ebons, USER.id)
+    tables = (db.DailyTotal, db.DailyProductTotal, db.ProductPrice)
+
+    def rollups():
+        with database.connect() as connection:
+            return [
+                sorted(connection.execute(sqlalchemy.select(table)).all())
+                for table in tables
+            ]
+
+    expected = rollups()
+    # A database from before the rollups: create_all adds them empty.
+    with database.begin() as connection:
+        for table in tables:
+            table.__table__.drop(connection)
+        connection.execute(sqlalchemy.update(db.SchemaVersion).values(version=5))
+    db.create_database(database)
+    assert rollups() == expected
+    assert all(expected)
+
+
+def test_migrate_duplicate_user_names(engine):
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DROP INDEX ix_users_name")
+        connection.execute(
+            sqlalchemy.insert(db.User),
+            [dict(name=name, password="") for name in ("bob", "alice", "bob")],
+        )
+        # A database from before the migrations.
+        connection.execute(sqlalchemy.delete(db.SchemaVersion))
+
+    db.create_database(engine)
+    with engine.connect() as connection:
+        names = connection.scalars(
+            sqlalchemy.select(db.User.name).order_by(db.User.id)
+        ).all()
+    assert names == ["bob", "alice", "bob#3"]
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        with engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.insert(db.User).values(name="bob", password="")
+            )
+
+
+def test_products(database):
+    ebons = []
+    for i, text in enumerate(generate_corpus(30)):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    rewe_process.store_rewe_ebons(ebons[:10], USER.id)
+    # The second batch resolves the names of the first one from the cache.
+    rewe_process.store_rewe_ebons(ebons[10:], USER.id)
+
+    with database.connect() as connection:
+        names = connection.execute(
+            sqlalchemy.select(db.Expense.name, db.Product.name).join(
+                db.Product, db.Product.id == db.Expense.product_id
+            )
+        ).all()
+        n_products = connection.scalar(
+            sqlalchemy.select(sqlalchemy.func.count()).select_from(db.Product)
+        )
+    assert len(names) == sum(len(expenses) for expenses, _, _ in ebons)
+    assert all(name == product for name, product in names)
+    assert n_products == len({name for name, _ in names})
+
+    totals = {}
+    for expenses, _, _ in ebons:
+        for expense in expenses:
+            totals[expense.name] = totals.get(expense.name, 0) + expense.value
+    start, stop = datetime.date(2000, 1, 1), datetime.date(2100, 1, 1)
+    product_sum = asyncio.run(db.retrieve_product_sum_async(USER, start, stop))
+    assert {name: pytest.approx(value) for name, value in totals.items()} == dict(
+        product_sum
+    )
+
+
+@contextlib.contextmanager
+def count_inserts(engine: sqlalchemy.Engine):
+    """Count the INSERT statements by table"""
+    inserts = collections.Counter()
+
+    def count(conn, cursor, statement, *args):
+        if statement.startswith("INSERT INTO"):
+            inserts[statement.split()[2]] += 1
+
+    sqlalchemy.event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield inserts
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", count)
+
+
+def test_store_inserts_in_bulk(database):
+    ebons = []
+    for i, text in enumerate(generate_corpus(50)):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    with count_inserts(database) as inserts:
+        bills = rewe_process.store_rewe_ebons(ebons, USER.id)
+    assert inserts["bills"] == 1
+    assert inserts["expenses"] == 1
+    assert inserts["products"] == 1
+
+    # The ids of the bills are mapped back to their eBons.
+    with database.connect() as connection:
+        for (bill_id, created), (expenses, total, file_hash) in zip(bills, ebons):
+            assert created
+            bill = connection.execute(
+                sqlalchemy.select(db.Bill.value, db.Bill.file_hash).where(
+                    db.Bill.id == bill_id
+                )
+            ).one()
+            assert tuple(bill) == (total, file_hash)
+            n_expenses = connection.scalar(
+                sqlalchemy.select(sqlalchemy.func.count()).where(
+                    db.Expense.bill_id == bill_id
+                )
+            )
+            assert n_expenses == len(expenses)
+
+
+def test_replace_inserts_in_bulk(database):
+    texts = generate_corpus(50)
+    ebons = []
+    for i, text in enumerate(texts):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    bills = rewe_process.store_rewe_ebons(ebons, USER.id)
+    with database.connect() as connection:
+        expected = connection.execute(
+            sqlalchemy.select(db.Expense.bill_id, db.Expense.name, db.Expense.value)
+        ).all()
+
+    replaced = []
+    for (bill_id, _), text in zip(bills, texts):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        replaced.append((bill_id, expenses, total))
+    with count_inserts(database) as inserts:
+        rewe_process.replace_rewe_ebons(replaced, USER.id)
+    assert inserts["expenses"] == 1
+    with database.connect() as connection:
+        actual = connection.execute(
+            sqlalchemy.select(db.Expense.bill_id, db.Expense.name, db.Expense.value)
+        ).all()
+    assert sorted(actual) == sorted(expected)
+
+
+def test_store_same_ebon_for_two_users(database):
+    [text] = generate_corpus(1)
+    other = db.User(name="other", password="")
+    with sqlalchemy.orm.Session(database, expire_on_commit=False) as session:
+        session.add(other)
+        session.commit()
+    bills = {}
+    for user in (USER, other):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        [(bills[user.id], created)] = rewe_process.store_rewe_ebons(
+            [(expenses, total, "0" * 64)], user.id
+        )
+        assert created
+    assert bills[USER.id] != bills[other.id]
+    bill = asyncio.run(db.jsonify_bill_async(other, bill_id=bills[other.id]))
+    assert bill["user_id"] == other.id
+    with pytest.raises(sqlalchemy.exc.NoResultFound):
+        asyncio.run(db.jsonify_bill_async(other, bill_id=bills[USER.id]))
+
+
+def test_claim_stale_jobs(database, monkeypatch):
+    monkeypatch.setattr(db, "async_engine", db.async_read_engine)
+    job = asyncio.run(db.add_job_async(USER, "ebon.pdf", "0" * 64, b"%PDF"))
+    now = datetime.datetime.now()
+    long_ago = now - datetime.timedelta(hours=1)
+    assert asyncio.run(db.claim_job_async(long_ago))[0] == job.id
+    # Running in another process, which keeps updating it.
+    assert asyncio.run(db.claim_job_async(long_ago)) is None
+    asyncio.run(db.touch_job_async(job.id))
+    assert asyncio.run(db.claim_job_async(now)) is None
+    # Not updated for too long, the worker running it is gone.
+    later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+    assert asyncio.run(db.claim_job_async(later))[0] == job.id
+
+
+def test_search(database):
+    ebons = []
+    for i, text in enumerate(generate_corpus(30)):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    rewe_process.store_rewe_ebons(ebons, USER.id)
+    names = [expense.name for expenses, _, _ in ebons for expense in expenses]
+
+    def search(text, **kwargs):
+        rows = asyncio.run(db.search_expenses_async(USER, text, **kwargs))
+        return [row["name"] for row in rows]
+
+    assert sorted(search("milch")) == sorted(n for n in names if "MILCH" in n)
+    assert sorted(search("EI")) == sorted(n for n in names if "EI" in n)
+    # Typos fall back to the closest product names.
+    assert set(search("HAFERFLOKEN ZART")) == {"HAFERFLOCKEN ZART"}
+    assert search("XYZXYZ") == []
+
+    rows = asyncio.run(db.search_expenses_async(USER, "milch", limit=3))
+    before = (rows[-1]["datetime"], rows[-1]["id"])
+    rest = asyncio.run(db.search_expenses_async(USER, "milch", before=before))
+    assert len(rows) + len(rest) == len(search("milch"))
+
+
+def test_product_prices(database):
+    ebons = []
+    for i, text in enumerate(generate_corpus(40)):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        ebons.append((expenses, total, f"{i:064x}"))
+    # The bills of the second batch are older and newer than the first one.
+    rewe_process.store_rewe_ebons(ebons[10:30], USER.id)
+    rewe_process.store_rewe_ebons(ebons[:10] + ebons[30:], USER.id)
+
+    def summaries():
+        with sqlalchemy.orm.Session(database) as session:
+            rows = session.scalars(sqlalchemy.select(db.ProductPrice)).all()
+            return {
+                (row.product_id, row.per_kg): db.orm_object_to_dict(row) for row in rows
+            }
+
+    incremental = summaries()
+    db.rebuild_rollups(USER.id)
+    assert incremental == summaries()
+
+    expenses = [e for expenses, _, _ in ebons for e in expenses]
+    name = max({e.name for e in expenses}, key=[e.name for e in expenses].count)
+    history = asyncio.run(db.get_price_history_async(USER, name))
+    assert len(history) == sum(e.name == name for e in expenses)
+    datetimes = [point["datetime"] for point in history]
+    assert datetimes == sorted(datetimes)
+    assert asyncio.run(db.get_price_history_async(USER, "UNKNOWN")) is None
+
+    changes = asyncio.run(db.get_price_changes_async(USER, 5))
+    assert changes
+    for change in changes:
+        first, last = change["first_price"], change["last_price"]
+        expected = (last - first) / abs(first)
+        assert change["change"] == pytest.approx(expected)
+    assert [abs(c["change"]) for c in changes] == sorted(
+        (abs(c["change"]) for c in changes), reverse=True
+    )
+
+
+def test_product_price_series(database):
+    def expense(name, value, **kwargs):
+        return db.Expense(name=name, value=value, datetime=dt, **kwargs)
+
+    dt = datetime.datetime(2024, 1, 1, 10)
+    first = [
+        expense("APFEL", 2.0, weight=1.0, price_per_kg=2.0),
+        expense("APFEL", 1.5, price_per_item=1.5),
+        # Bought twice on one bill, the earlier expense is the first price.
+        expense("BROT", 2.0),
+        expense("BROT", 3.0),
+    ]
+    dt = datetime.datetime(2024, 2, 1, 10)
+    second = [
+        expense("APFEL", 1.5, weight=0.5, price_per_kg=3.0),
+        expense("APFEL", 1.0, price_per_item=1.0),
+        expense("BROT", 4.0),
+        expense("BROT", 5.0),
+    ]
+    ebons = [(first, 8.5, "0" * 64), (second, 11.5, "1" * 64)]
+    rewe_process.store_rewe_ebons(ebons, USER.id)
+
+    def summaries():
+        query = (
+            sqlalchemy.select(
+                db.Product.name,
+                db.ProductPrice.per_kg,
+                db.ProductPrice.first_price,
+                db.ProductPrice.last_price,
+            )
+            .join(db.Product, db.Product.id == db.ProductPrice.product_id)
+            .order_by(db.Product.name, db.ProductPrice.per_kg)
+        )
+        with database.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    expected = [
+        ("APFEL", False, 1.5, 1.0),
+        ("APFEL", True, 2.0, 3.0),
+        ("BROT", False, 2.0, 5.0),
+    ]
+    assert summaries() == expected
+    db.rebuild_rollups(USER.id)
+    assert summaries() == expected
+
+    # A database from before the series: one row per product.
+    with database.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE product_prices")
+        connection.exec_driver_sql(
+            "CREATE TABLE product_prices (product_id INTEGER PRIMARY KEY, "
+            "user_id INTEGER, per_kg BOOLEAN, first_datetime DATETIME, "
+            "first_price FLOAT, last_datetime DATETIME, last_price FLOAT, "
+            "count INTEGER)"
+        )
+        connection.execute(sqlalchemy.update(db.SchemaVersion).values(version=6))
+    db.create_database(database)
+    assert summaries() == expected
+
+
+def test_seed_dataset(database):
+    today = datetime.date(2025, 6, 30)
+    users = dataset.seed(3, 1, n_products=50, today=today)
+    with database.connect() as connection:
+        rows = connection.execute(
+            sqlalchemy.select(db.Bill.user_id, db.Bill.datetime)
+        ).all()
+        n_products = connection.scalar(
+            sqlalchemy.select(sqlalchemy.func.count(db.Product.name.distinct()))
+        )
+    assert {user_id for user_id, _ in rows} == {user.id for user in users}
+    assert len(set(rows)) == len(rows)
+    assert all(
+        today - datetime.timedelta(days=365) <= dt.date() <= today for _, dt in rows
+    )
+    # The weighed and butcher products do not come from the catalog.
+    extra = {*WEIGHED_PRODUCTS, *BUTCHER_PRODUCTS}
+    assert n_products <= 50 + len(extra)
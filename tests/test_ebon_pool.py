@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+
+import ebon_pool
+from benchmarks.ebon_text import generate_corpus, render_pdf
+
+
+def test_timeout_recycles_workers(monkeypatch):
+    [text] = generate_corpus(1)
+    pdf = render_pdf(text)
+    # Shorter than starting a worker, so the job is still running.
+    monkeypatch.setattr(ebon_pool, "PDF_TIMEOUT", 0.001)
+    executor = ebon_pool._get_executor()
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(ebon_pool.extract(pdf))
+    assert e.value.status_code == 504
+    # The worker is killed instead of finishing the job.
+    assert ebon_pool._executor is not executor
+    for _ in range(100):
+        if ebon_pool._slots._value == ebon_pool.PDF_QUEUE_DEPTH:
+            break
+        time.sleep(0.05)
+    assert ebon_pool._slots._value == ebon_pool.PDF_QUEUE_DEPTH
+
+    monkeypatch.setattr(ebon_pool, "PDF_TIMEOUT", 30)
+    try:
+        expenses, total = asyncio.run(ebon_pool.extract(pdf))
+    finally:
+        ebon_pool.shutdown()
+    assert expenses
+    assert total > 0
@@ -0,0 +1,58 @@
+import asyncio
+import types
+
+import sqlalchemy
+
+import metrics
+
+
+def test_histogram():
+    histogram = metrics.Histogram("test_seconds", "Test.", ("name",), [0.1, 1])
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, 'a "b"')
+    assert histogram.render() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{name="a \\"b\\"",le="0.1"} 2',
+        'test_seconds_bucket{name="a \\"b\\"",le="1"} 3',
+        'test_seconds_bucket{name="a \\"b\\"",le="+Inf"} 4',
+        'test_seconds_sum{name="a \\"b\\""} 3.65',
+        'test_seconds_count{name="a \\"b\\""} 4',
+    ]
+    assert "# TYPE test_seconds histogram" in metrics.render()
+
+
+def test_request_stats():
+    engine = sqlalchemy.create_engine("sqlite://")
+    metrics.instrument_engine(engine)
+    # The middleware counts the queries of the request and passes everything
+    # else through.
+    app_queries = 3
+
+    async def app(scope, receive, send):
+        with engine.connect() as connection:
+            for _ in range(app_queries):
+                connection.execute(sqlalchemy.text("SELECT 1"))
+        with metrics.stage("test"):
+            stats = metrics._request_stats.get()
+        assert stats.queries == app_queries
+        assert stats.query_seconds > 0
+        assert "test" in stats.stages
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def send(message):
+        pass
+
+    # The router stores the matched route in the scope.
+    route = types.SimpleNamespace(path="/test/{id}")
+    scope = {"type": "http", "method": "GET", "path": "/test/1", "route": route}
+    asyncio.run(metrics.MetricsMiddleware(app)(scope, None, send))
+    assert metrics._request_stats.get() is None
+    assert 'http_request_queries_sum{route="/test/{id}"} 3.0' in (
+        metrics.REQUEST_QUERIES.render()
+    )
+    assert (
+        'http_request_duration_seconds_count{method="GET",route="/test/{id}",'
+        'status="201"} 1'
+    ) in metrics.REQUEST_SECONDS.render()
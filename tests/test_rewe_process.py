@@ -0,0 +1,54 @@
+import re
+
+import db
+import rewe_process
+from benchmarks.ebon_text import generate_corpus, render_pdf
+
+EDGE_CASE_LINES = [
+    "",
+    "LEERGUT                          -0,25 A",
+    "PFAND 0,25 EURO                   0,25 A *",
+    "    12.06.2024 18:22",
+    "  12.06.2024   18:22  Bon-Nr.:1234",
+    "B=  7,0%     10,00      0,70     10,70",
+    "Datum: 12.06.2024 Uhrzeit: 18:22:11 Uhr",
+    "SUMME EUR 0,00",
+]
+
+
+def classify_reference(line: str):
+    # The classification before LINE_CLASSIFIER: every pattern is searched in
+    # order until one matches.
+    for kind, _, pattern in rewe_process.LINE_CLASSIFIER:
+        if m := re.search(pattern.pattern, line):
+            return kind, m.groups()
+    return None, None
+
+
+def test_line_classifier():
+    classify = getattr(rewe_process, "__classify_line")
+    lines = list(EDGE_CASE_LINES)
+    for text in generate_corpus(200):
+        lines += text.split("\n")
+    for line in lines:
+        kind, m = classify(line)
+        assert (kind, None if m is None else m.groups()) == classify_reference(line)
+
+
+def test_parse_synthetic_ebons():
+    for text in generate_corpus(50):
+        expenses, total = rewe_process.parse_rewe_ebon_text(text)
+        assert expenses
+        assert total > 0
+
+
+def test_extract_rendered_ebons():
+    # The benchmarks upload rendered eBons, pdfminer has to see the same text.
+    for text in generate_corpus(5):
+        expected = rewe_process.parse_rewe_ebon_text(text)
+        (expenses, total), stages = rewe_process.extract_rewe_ebon(render_pdf(text))
+        assert set(stages) == {"extract", "parse"}
+        assert total == expected[1]
+        assert [db.orm_object_to_dict(e) for e in expenses] == [
+            db.orm_object_to_dict(e) for e in expected[0]
+        ]
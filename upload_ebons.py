@@ -1,7 +1,10 @@
 import argparse
+import concurrent.futures
+import functools
 import hashlib
 import os
 import pathlib
+import time
 
 import requests
 from dotenv import load_dotenv
@@ -13,6 +16,7 @@ USER_DATA = {
     "username": os.getenv("USER_NAME"),
     "password": os.getenv("USER_PASSWORD"),
 }
+MAX_RETRIES = 5
 
 
 def parse_args() -> argparse.Namespace:
@@ -30,19 +34,37 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Reset database (only for localhost)",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent uploads",
+    )
     args = parser.parse_args()
     return args
 
 
-def login(server: str) -> str:
-    response = requests.post(f"{server}/api/login", json=USER_DATA)
+def create_session(workers: int) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=workers,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def login(session: requests.Session, server: str) -> str:
+    response = session.post(f"{server}/api/login", json=USER_DATA)
     assert response.status_code == 200
     token = response.json()["token"]
     headers = {"Authorization": "Bearer " + token}
     return headers
 
 
-def reset_db(server: str):
+def reset_db(session: requests.Session, server: str):
     assert "localhost" in server
     import db
 
@@ -50,40 +72,76 @@ def reset_db(server: str):
     db.clean()
     db.create_database()
     print(f"Creating user {USER_DATA['username']}")
-    response = requests.post(f"{server}/api/register", json=USER_DATA)
+    response = session.post(f"{server}/api/register", json=USER_DATA)
     assert response.status_code == 201
 
 
+def read_ebon(file_path: pathlib.Path) -> tuple[str, bytes]:
+    """Return the SHA-256 and the content of an eBon
+
+    The hash is not taken from the name, the eBon folder may hold files that
+    were renamed or not saved by download_rewe_mails.py.
+    """
+    with open(file_path, "rb") as fd:
+        ebon = fd.read()
+    return hashlib.sha256(ebon).hexdigest(), ebon
+
+
+def upload(
+    session: requests.Session, server: str, file_path: pathlib.Path, ebon: bytes
+) -> dict:
+    for _ in range(MAX_RETRIES):
+        files = {"file": (file_path.name, ebon)}
+        response = session.post(f"{server}/api/pdfs", files=files)
+        if response.status_code != 503:
+            break
+        # The server is busy parsing other eBons.
+        time.sleep(int(response.headers.get("Retry-After", 1)))
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code} {response.text}")
+    return response.json()
+
+
 def main():
     args = parse_args()
+    session = create_session(args.workers)
     if args.reset_db:
-        reset_db(args.server)
-    headers = login(args.server)
-    response = requests.get(f"{args.server}/api/bills/hashes", headers=headers)
-    assert response.status_code == 200
-    hashes = response.json()
+        reset_db(session, args.server)
+    session.headers.update(login(session, args.server))
 
-    stats_skipped = 0
     ebons = list(EBON_DIR.glob("REWE-eBon*pdf"))
-    for file_path in ebons:
-        with open(file_path, "rb") as fd:
-            ebon = fd.read()
-        file_hash = hashlib.sha256(ebon).hexdigest()
-        if file_hash in hashes:
-            stats_skipped += 1
-            continue
-        # The eBon does not exist on the server, so we upload it.
-        with open(file_path, "rb") as fd:
-            files = {"file": fd}
-            response = requests.post(
-                f"{args.server}/api/pdfs",
-                files=files,
-                headers=headers,
-            )
-            assert response.status_code == 200
-        datetime_str = response.json()["datetime"]
-        print(f"Uploaded bill from {datetime_str}")
-    print(f"Skipped {stats_skipped} of {len(ebons)} eBons")
+    with concurrent.futures.ThreadPoolExecutor(args.workers) as executor:
+        # Every eBon is read once, the missing ones are uploaded from memory.
+        contents = {}
+        for path, (hash_, ebon) in zip(ebons, executor.map(read_ebon, ebons)):
+            contents[hash_] = (path, ebon)
+        response = session.post(
+            f"{args.server}/api/bills/hashes/missing",
+            json=list(contents),
+        )
+        assert response.status_code == 200
+        missing = [contents[hash_] for hash_ in response.json()]
+        # The eBons the server knows are not needed anymore.
+        contents.clear()
+
+        # The eBons that do not exist on the server are uploaded. A failed
+        # upload does not stop the others, the failures are listed at the end.
+        upload_ = functools.partial(upload, session, args.server)
+        futures = {executor.submit(upload_, path, ebon): path for path, ebon in missing}
+        errors = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                data = future.result()
+            except (requests.RequestException, RuntimeError) as e:
+                errors.append((futures[future], e))
+                continue
+            print(f"Uploaded bill from {data['datetime']}")
+    print(f"Skipped {len(ebons) - len(missing)} of {len(ebons)} eBons")
+    if errors:
+        print(f"Failed to upload {len(errors)} eBons:")
+        for path, error in sorted(errors):
+            print(f"  {path.name}: {error}")
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
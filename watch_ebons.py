@@ -0,0 +1,178 @@
+import argparse
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import pathlib
+import re
+
+import watchfiles
+
+import db
+import download_rewe_mails
+import reprocess_ebons
+import rewe_process
+
+DATA_DIR = (pathlib.Path(__file__).parent / "data").resolve()
+EBON_DIR = DATA_DIR / "ebons"
+TEXT_CACHE_DIR = DATA_DIR / "ebon_texts"
+# download_rewe_mails.py names the eBons after the SHA-256 of their content.
+EBON_NAME_PATTERN = re.compile(r"REWE-eBon-([0-9a-f]{64})\.pdf")
+BATCH_SIZE = 500
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        "Watch the mail folder and the eBon directory and store new eBons"
+    )
+    parser.add_argument(
+        "-u",
+        "--user",
+        type=str,
+        required=True,
+        help="User owning the eBons",
+    )
+    parser.add_argument(
+        "-m",
+        "--mail-dir",
+        type=pathlib.Path,
+        help="Directory to mail folder from getmail",
+    )
+    parser.add_argument(
+        "-d",
+        "--ebon-dir",
+        type=pathlib.Path,
+        default=EBON_DIR,
+        help="Directory with the eBon PDFs",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=500,
+        help="Milliseconds to wait for more changes before storing a batch",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="Number of worker processes",
+    )
+    args = parser.parse_args()
+    if args.mail_dir is not None and not (args.mail_dir / "new").exists():
+        raise SystemExit(f"{args.mail_dir} seems to be an incorrect mail directory")
+    return args
+
+
+def is_mail(path: pathlib.Path) -> bool:
+    return path.parent.name == "new" and path.name.endswith(".L")
+
+
+def is_ebon(path: pathlib.Path) -> bool:
+    return path.name.startswith("REWE-eBon") and path.suffix == ".pdf"
+
+
+def ebon_hash(path: pathlib.Path) -> str | None:
+    if m := EBON_NAME_PATTERN.fullmatch(path.name):
+        return m.group(1)
+    return None
+
+
+def ingest(
+    user: db.User,
+    paths: list[pathlib.Path],
+    executor: concurrent.futures.Executor,
+):
+    """Parse and store the eBons the user has no bill for yet"""
+    hashes = {path: ebon_hash(path) for path in paths}
+    named = [hash_ for hash_ in hashes.values() if hash_ is not None]
+    missing = set(db.find_missing_hashes(user, named))
+    # eBons not named after their hash are hashed while parsing and
+    # deduplicated by store_rewe_ebons.
+    paths = [
+        path for path, hash_ in hashes.items() if hash_ is None or hash_ in missing
+    ]
+    if not paths:
+        return
+
+    process = functools.partial(reprocess_ebons.process_ebon, cache_dir=TEXT_CACHE_DIR)
+    parsed = []
+    for path, file_hash, result in executor.map(process, paths):
+        if isinstance(result, Exception):
+            print(f"Failed to parse {path}: {result!r}")
+            continue
+        expenses, total = result
+        parsed.append((expenses, total, file_hash))
+    created = 0
+    for i in range(0, len(parsed), BATCH_SIZE):
+        results = rewe_process.store_rewe_ebons(parsed[i : i + BATCH_SIZE], user.id)
+        created += sum(is_new for _, is_new in results)
+    print(f"Stored {created} of {len(paths)} new eBons")
+
+
+def catch_up(
+    user: db.User,
+    mail_dir: pathlib.Path | None,
+    ebon_dir: pathlib.Path,
+    executor: concurrent.futures.Executor,
+):
+    """Store what arrived while the watcher was not running
+
+    The mail manifest skips the mails that were processed already and the
+    eBons whose hash is known to the database are not parsed again, so a
+    restart after a crash neither loses nor duplicates bills.
+    """
+    ebons = {path for path in ebon_dir.glob("*.pdf") if is_ebon(path)}
+    if mail_dir is not None:
+        ebons.update(download_rewe_mails.extract_attachments(mail_dir))
+    ingest(user, sorted(ebons), executor)
+
+
+def watch(
+    user: db.User,
+    mail_dir: pathlib.Path | None,
+    ebon_dir: pathlib.Path,
+    executor: concurrent.futures.Executor,
+    debounce: int,
+):
+    watched = [ebon_dir] if mail_dir is None else [mail_dir / "new", ebon_dir]
+    print(f"Watching {', '.join(str(path) for path in watched)}")
+    # watchfiles groups the changes arriving within the debounce time, each
+    # group is stored as one batch.
+    for changes in watchfiles.watch(*watched, debounce=debounce, recursive=False):
+        paths = {
+            pathlib.Path(path)
+            for change, path in changes
+            if change != watchfiles.Change.deleted
+        }
+        paths = {path for path in paths if path.exists()}
+        mails = [path for path in paths if is_mail(path)]
+        ebons = {path for path in paths if is_ebon(path)}
+        if mails:
+            ebons.update(download_rewe_mails.extract_mail_files(mails))
+        if ebons:
+            ingest(user, sorted(ebons), executor)
+
+
+def main():
+    args = parse_args()
+    db.create_database()
+    user = db.find_user(args.user)
+    if user is None:
+        raise SystemExit(f"Unknown user {args.user}")
+    args.ebon_dir.mkdir(parents=True, exist_ok=True)
+    TEXT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        catch_up(user, args.mail_dir, args.ebon_dir, executor)
+        try:
+            watch(user, args.mail_dir, args.ebon_dir, executor, args.debounce)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+
+if __name__ == "__main__":
+    main()